@@ -0,0 +1,122 @@
+"""
+An on-disk cache of password scores (see guessing.score), in SQLite.
+
+Scores are keyed by the fingerprint of a grammar folder (a hash of the files
+in it that determine the scores: the grammar, its tree cuts and its word_tags
+table) and the password, so one cache serves many grammars and a grammar
+trained again never reads stale scores. Data outside the folder (the POS
+tagger and WordNet) isn't part of the fingerprint: delete the cache after
+updating it. Every process opens its own connection, on first use, so none
+is carried across fork(); the database is in WAL mode, so they read while
+another one writes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+
+FINGERPRINT_FILES = ('grammar.bin', 'noun_treecut.pickle', 'verb_treecut.pickle', 'word_tags.bin')
+VERSION = 1  # of the scorer, part of every fingerprint
+
+
+def fingerprint(grammar_dir):
+    """ Returns a hash of the files of a grammar folder that determine its
+    scores (grammar.pickle stands for grammar.bin in older folders).
+    """
+    names = list(FINGERPRINT_FILES)
+    if not os.path.exists(os.path.join(grammar_dir, 'grammar.bin')):
+        names[0] = 'grammar.pickle'
+
+    h = hashlib.sha256('score v{}'.format(VERSION).encode('utf-8'))
+    for name in names:
+        path = os.path.join(grammar_dir, name)
+        if not os.path.exists(path):
+            continue
+        h.update(name.encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+class ScoreCache(object):
+    """ Maps (grammar fingerprint, password) to the result of Scorer.score().
+    Writes are committed by flush(). With max_size, flush() removes the
+    oldest entries (of any grammar) beyond max_size.
+    """
+
+    def __init__(self, path, fingerprint, max_size=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._pid = None
+        self._grammar_id = None
+
+    def connection(self):
+        """ Returns the connection of this process (opened on first use). """
+        if self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS grammars ('
+                       'id INTEGER PRIMARY KEY, fingerprint TEXT UNIQUE NOT NULL)')
+            # p has no type, so that it keeps the type it's stored with (0 for no parse)
+            db.execute('CREATE TABLE IF NOT EXISTS scores ('
+                       'id INTEGER PRIMARY KEY, grammar INTEGER NOT NULL, password TEXT NOT NULL, '
+                       'base_struct TEXT, split TEXT, p NOT NULL, UNIQUE (grammar, password))')
+            db.execute('INSERT OR IGNORE INTO grammars (fingerprint) VALUES (?)', (self.fingerprint,))
+            db.commit()
+            self._grammar_id = db.execute('SELECT id FROM grammars WHERE fingerprint = ?',
+                                          (self.fingerprint,)).fetchone()[0]
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def get(self, password):
+        """ Returns the cached result of a password, or None. """
+        row = self.connection().execute(
+            'SELECT base_struct, split, p FROM scores WHERE grammar = ? AND password = ?',
+            (self._grammar_id, password)).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        base_struct, split, p = row
+        return (password, base_struct, json.loads(split) if split is not None else None, p)
+
+    def put(self, result):
+        password, base_struct, split, p = result
+        self.connection().execute(
+            'INSERT OR IGNORE INTO scores (grammar, password, base_struct, split, p) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (self._grammar_id, password, base_struct,
+             json.dumps(split) if split is not None else None, p))
+
+    def flush(self):
+        db = self.connection()
+        if self.max_size is not None:
+            # ids only grow and the oldest are removed first, so they are contiguous
+            low, high = db.execute('SELECT min(id), max(id) FROM scores').fetchone()
+            if high is not None and high - low + 1 > self.max_size:
+                db.execute('DELETE FROM scores WHERE id <= ?', (high - self.max_size,))
+        db.commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        if self._pid == os.getpid():
+            self.flush()
+            self._db.close()
+        self._db = None
+        self._pid = None
+
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        d['_db'] = None  # every process opens its own connection
+        d['_pid'] = None
+        return d
@@ -1,20 +1,115 @@
 """
 Outputs a password sample of a given size from a grammar.
+
+The sample is drawn in blocks of a fixed size, each with its own random
+generator spawned from a single seed (numpy.random.SeedSequence). Blocks can
+be spread over several worker processes, which write them straight to the
+output, one whole block at a time. For a given seed the sample is always the
+same multiset of passwords, whatever the number of workers (only the order
+of the blocks may change).
 """
 import argparse
+import os
+import sys
+
+from multiprocessing import Lock, Pool
+
+import numpy as np
 
 from learning import model
 
+# set in every worker by _init_worker()
+_grammar = None
+_fd = None
+_lock = None
+
+
+def format_block(outcomes):
+    return ''.join("{}\t{}\n".format(password, p) for password, _, p in outcomes)
+
+
+def _write_all(fd, data):
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def _init_worker(grammar, output, lock):
+    global _grammar, _fd, _lock
+    _grammar = grammar
+    _fd = os.open(output, os.O_WRONLY | os.O_APPEND) if output else sys.stdout.fileno()
+    _lock = lock
+
+
+def _sample_block(block):
+    seed, size = block
+    rng = np.random.default_rng(seed)
+    data = format_block(_grammar.sampler().sample(size, rng)).encode('utf-8')
+
+    with _lock:
+        _write_all(_fd, data)
+
+    return size
+
+
+def blocks(N, seed=None, block_size=100000):
+    """ Split a sample of size N into blocks, returning a list of tuples
+    (SeedSequence, block size). Depends only on N, seed and block_size.
+    """
+    n_blocks = -(-N // block_size)
+    seeds = np.random.SeedSequence(seed).spawn(n_blocks)
+    sizes = [block_size] * (n_blocks - 1) + [N - block_size * (n_blocks - 1)]
+    return list(zip(seeds, sizes)) if N > 0 else []
+
+
+def write_sample(grammar, N, output=None, seed=None, num_workers=1,
+                 block_size=100000):
+    """ Write a sample of N passwords from a grammar, one password and its
+    probability per line (tab-separated).
+
+    Args:
+        grammar - a Grammar
+        N - sample size
+        output - path of the output file (overwritten), or None for stdout
+        seed - an int (or None, for fresh entropy)
+        num_workers - number of processes
+        block_size - number of passwords drawn at once by a worker
+    """
+    if output:
+        open(output, 'wb').close()
+    sys.stdout.flush()
+
+    grammar.sampler()  # build the tables once, before forking
+    lock = Lock()
+
+    if num_workers > 1:
+        with Pool(num_workers, initializer=_init_worker,
+                  initargs=(grammar, output, lock)) as pool:
+            for _ in pool.imap_unordered(_sample_block, blocks(N, seed, block_size)):
+                pass
+    else:
+        _init_worker(grammar, output, lock)
+        for block in blocks(N, seed, block_size):
+            _sample_block(block)
+        if output:
+            os.close(_fd)
+
 
 def options():
     parser = argparse.ArgumentParser()
     parser.add_argument('N', type=int, default=1000)
     parser.add_argument('grammar_dir')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file (default: stdout)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='the same seed yields the same sample')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+                        help='number of cores available for parallel work')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     opts = options()
     grammar = model.Grammar.from_files(opts.grammar_dir)
-    for password, base_struct, p in grammar.sample(opts.N):
-        print("{}\t{}".format(password, p))
+
+    write_sample(grammar, opts.N, opts.output, opts.seed, opts.num_workers)
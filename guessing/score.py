@@ -4,17 +4,21 @@ import argparse
 import configparser
 import functools
 import pickle
-import re
+import shutil
 import sys
-from collections import deque
-from itertools import chain
+import tempfile
+from collections import Counter, deque
+from heapq import heappop, heappush, heapreplace
+from itertools import chain, islice
+from multiprocessing import Pool
 from pathlib import Path
 
 import pandas as pd
 from nltk.corpus import wordnet as wn
 from wordsegment import Segmenter
 
-from learning import model
+from guessing.cache import ScoreCache, fingerprint
+from learning import model, storage
 from learning.pos import ExhaustiveTagger
 from learning.tagset_conversion import TagsetConverter
 
@@ -78,7 +82,6 @@ class MemoTagger():
         self.tc_verbs = tc_verbs
         self.grammar = grammar
         self.tagconv = TagsetConverter()
-        self.tag_prob_cache = dict()
 
     @functools.lru_cache(maxsize=10000)
     def get_pos(self, string):
@@ -109,27 +112,7 @@ class MemoTagger():
         return self.grammar.tagger._get_tag(string, pos, synset, self.grammar.tagtype)
 
     def prob(self, tag, string):
-        tag_prob_cache = self.tag_prob_cache
-        grammar = self.grammar
-
-        if tag not in tag_prob_cache:
-            tag_prob_cache[tag] = dict()
-            samplesize = sum(grammar.tag_dicts[tag].values())
-            vocabsize = len(grammar.tag_dicts[tag])
-
-            if grammar.estimator == 'laplace':
-                estimator = model.LaplaceEstimator(samplesize, vocabsize, 1)
-            else:
-                estimator = model.MleEstimator(samplesize)
-
-            entries = map(lambda x, e=estimator: (x[0], e.probability(x[1])), grammar.tag_dicts[tag].items())
-
-            tag_prob_cache[tag].update(entries)
-
-        try:
-            return tag_prob_cache[tag][string]
-        except KeyError:
-            return 0
+        return self.grammar.probability_index().prob(tag, string)
 
     @functools.lru_cache(maxsize=10000)
     def get_tags(self, word):
@@ -152,8 +135,7 @@ class GrammarTable():
         records = []
 
         for i, struct in enumerate(grammar.base_structures.keys()):
-            tags = re.findall(r"[\w.]+", struct)
-            for j, tag in enumerate(tags):
+            for j, tag in enumerate(grammar.struct_tags(struct)):
                 records.append((i, tag, j))
 
         self.table = pd.DataFrame.from_records(records,
@@ -168,20 +150,18 @@ class GrammarTable():
 
 class BaseStructChecker():
     def __init__(self, grammar):
-        self.cache = set()
-
-        for i, struct in enumerate(grammar.base_structures.keys()):
-            tags = re.findall(r"[\w\-\'.]+", struct)
-            acc = ''
-            for tag in tags:
-                acc += '(' + tag + ')'
-                self.cache.add(acc)
+        self.tag_table = grammar.tag_table
+        self.automaton = grammar.tag_automaton()
 
     def exists(self, tags):
-        if type(tags) == str:
-            return tags in self.cache
-        else:
-            return '(' + ')('.join(tags) + ')' in self.cache
+        """ Args:
+            tags - a tuple of tag ids or a list of tags
+        """
+        if type(tags) != tuple:
+            tags = self.tag_table.lookup(tags)
+            if tags is None:
+                return False
+        return self.automaton.walk(tags) > 0
 
 
 class GraphNode():
@@ -197,7 +177,7 @@ class GrammarGraph():
         self._next_node_id = 0
 
         for struct in grammar.base_structures.keys():
-            tags = re.findall(r"[\w.]+", struct)
+            tags = grammar.struct_tags(struct)
             tags.insert(0, '^')
             tags.append('$')
             for i, (tag1, tag2) in enumerate(zip(tags[:-1], tags[1:])):
@@ -230,130 +210,420 @@ class GrammarGraph():
 # %% -----------------------------------------------------------------
 
 
-class PrefixTreeNode():
-    def __init__(self, word, p=0, tag=None, parent=None):
-        self.word = word
-        self.p = p
-        self.parent = parent
-        self.children = []
-        self.depth = 0
-        self.sequence_p = p
-        self.base_struct = '(' + tag + ')' if tag is not None else ''
-        self.tag = tag
+class Scorer(object):
+    """ Finds the most probable rule that outputs a password, if any. Holds
+    the tables derived from the grammar, so it is built once and reused for
+    every password (see score()).
+    """
+
+    def __init__(self, grammar, tc_nouns, tc_verbs, postagger=None, vocab=None,
+                 word_tags=None):
+        """ Args:
+            word_tags - a storage.WordTags, the tags of the vocabulary
+                precomputed by guessing.word_tags. If given, no tagger,
+                WordNet or tree cuts are used (tc_nouns and tc_verbs may be None).
+        """
+        if vocab is None:
+            vocab = grammar.vocabulary()
+
+        self.grammar = grammar
+        self.vocab = vocab
+        self.trie = vocab.trie() if hasattr(vocab, 'trie') else None
+
+        self.word_tags = word_tags
+        self.memotagger = None
+        if word_tags is None:
+            if postagger is None:
+                postagger = ExhaustiveTagger.from_pickle()
+            self.memotagger = MemoTagger(postagger, tc_nouns, tc_verbs, grammar)
+
+        self.tag_ids = grammar.tag_table.ids
+        self.automaton = grammar.tag_automaton()
+
+    def tags(self, word):
+        """ Returns the tags of a (lowercase) word that can produce it, as
+        a list of tuples (tag id, p).
+        """
+        if self.word_tags is not None:
+            return [(tag_id, p) for tag_id, p in self.word_tags.lookup(word)
+                    if tag_id >= 0 and p > 0]
+
+        tag_ids = self.tag_ids
+        return [(tag_ids[tag], p) for tag, p in self.memotagger.get_tags(word)
+                if tag in tag_ids and p > 0]
+
+    def score(self, password):
+        """ Returns a tuple (password, base structure, segmentation, probability)
+        of the most probable parse of a password (see parses()), or
+        (password, None, None, 0) if it has none.
+        """
+        parses = self.parses(password)
+        return parses[0] if parses else (password, None, None, 0)
+
+    def parses(self, password, k=1):
+        """ Returns the k most probable parses of a password, most probable
+        first, as tuples (password, base structure, segmentation, probability).
+        The test is done with a lowercased version of the password.
+
+        Segmentations are explored as a lattice over the positions of the
+        password: a state is the state of the tag automaton after the tags
+        of the words up to a position, and only the k most probable ways to
+        reach every state are kept. States are expanded best-first, by an
+        upper bound of the probability of the parses through them (see
+        TagAutomaton.upper_bounds()), so a state is taken off the queue in
+        decreasing order of probability and the search ends with the k-th
+        complete parse taken off the queue. Every way to reach a state is a
+        distinct sequence of words and tags, so the parses are distinct.
+        """
+        vocab = self.vocab
+        automaton = self.automaton
+        step = automaton.step
+        limit = segmenter.limit
+        n = len(password)
+
+        if self.trie is not None and password.isascii():
+            # only the words of the vocabulary, in one walk of the trie per position
+            lowered = password.lower()
+            words = lambda i: self.trie.prefixes(lowered, i, limit)
+        else:
+            words = lambda i: (j for j in range(i + 1, min(n, i + limit) + 1)
+                                if password[i:j].lower() in vocab)
+
+        accept = automaton.accept
+        bounds = automaton.upper_bounds()
+
+        # splits[i] = list of tuples (end, [(tag id, p), ...]) of the words at i
+        splits = [None] * n
+
+        # edges[i][state] = list of tuples (end, next state, p, upper bound of
+        # the rest) of the words and tags that follow a state at i
+        edges = [dict() for _ in range(n + 1)]
+
+        # kept[i][state] = heap of the probabilities of the k most probable
+        # ways to reach a state queued so far (the lowest first); once there
+        # are k, floor[i][state] = the lowest, which a new way has to beat
+        kept = [dict() for _ in range(n + 1)]
+        floor = [dict() for _ in range(n + 1)]
+
+        # paths[i][state] = list of tuples (p, start of the last word, previous
+        # state, rank of the previous path) of the ways to reach a state taken
+        # off the queue, the most probable first
+        paths = [dict() for _ in range(n + 1)]
+
+        # best-first: entries (-upper bound, position, state, p, start of the
+        # last word, previous state, rank of the previous path); the bound of
+        # a complete parse (position n) is its probability
+        heap = [(-bounds[0], 0, 0, 1, None, None, None)] if n > 0 else []
 
-    def append_child(self, node):
-        self.children.append(node)
-        node.parent = self
-        node.depth = self.depth + 1
-        node.sequence_p = node.p * self.sequence_p
-        node.base_struct = self.base_struct + node.base_struct
-
-    def dfs(self):
-        stack = deque([self])
-        while len(stack) > 0:
-            node = stack.pop()
-            for child in node.children:
-                stack.append(child)
-            yield node
-
-    def prefix_path(self):
-        p = self
-        while p is not None:
-            yield p
-            p = p.parent
-
-    def leaves(self):
-        for node in self.dfs():
-            if len(node.children) == 0:
-                yield node
+        complete = []  # tuples (state, rank, p) of the complete parses
+
+        while heap:
+            bound, i, state, state_p, start, previous, previous_rank = heappop(heap)
+
+            done = paths[i].setdefault(state, [])
+            if len(done) == k:  # its k most probable ways were taken before
+                continue
+            rank = len(done)
+            done.append((state_p, start, previous, previous_rank))
+
+            if i == n:  # no other parse can be more probable
+                complete.append((state, rank, -bound))
+                if len(complete) == k:
+                    break
+                continue
+
+            if splits[i] is None:
+                splits[i] = []
+                for j in words(i):
+                    word = password[i:j].lower()
+
+                    # check if a number sequence was split
+                    if word[-1].isdigit() and j < n and password[j].isdigit(): continue
+
+                    tags = self.tags(word)
+                    if tags:
+                        splits[i].append((j, tags))
+
+            out = edges[i].get(state)
+            if out is None:
+                out = []
+                for j, tags in splits[i]:
+                    for tag_id, p in tags:
+                        # if this tag never occurs after the state in the grammar
+                        # then ignore this split
+                        new_state = step(state, tag_id)
+                        if new_state < 0:
+                            continue
+
+                        factor = accept[new_state] if j == n else bounds[new_state]
+                        if factor > 0:
+                            out.append((j, new_state, p, factor))
+                if k > 1:  # expanded again by the next ways to reach the state
+                    edges[i][state] = out
+
+            for j, new_state, p, factor in out:
+                new_p = state_p * p
+                if new_p <= floor[j].get(new_state, 0):
+                    continue
+
+                if k == 1:
+                    floor[j][new_state] = new_p
+                else:
+                    top = kept[j].get(new_state)
+                    if top is None:
+                        kept[j][new_state] = top = [new_p]
+                    elif len(top) < k:
+                        heappush(top, new_p)
+                    else:
+                        heapreplace(top, new_p)
+                    if len(top) == k:
+                        floor[j][new_state] = top[0]
+
+                heappush(heap, (-new_p * factor, j, new_state, new_p, i, state, rank))
+
+        parses = []
+        for state, rank, p in complete:
+            base_struct = self.grammar.struct_strings[automaton.struct(state)]
+
+            segmentation = []
+            j = n
+            while state:
+                _, i, previous, previous_rank = paths[j][state][rank]
+                segmentation.append(password[i:j])
+                j, state, rank = i, previous, previous_rank
+            segmentation.append('')  # the root, for output compatible with older versions
+            segmentation.reverse()
+
+            parses.append((password, base_struct, segmentation, p))
+        return parses
 
 
 def score(passwords, grammar, tc_nouns,
-          tc_verbs, postagger=None, vocab=None):
+          tc_verbs, postagger=None, vocab=None, scorer=None, cache=None):
     """
     For each password finds the most probable rule that outputs
     it, if any. The test is done with a lowercased version of the
-    password.
-    """
+    password. Yields tuples (password, base structure, segmentation,
+    probability).
 
-    if postagger is None:
-        postagger = ExhaustiveTagger.from_pickle()
-    if vocab is None:
-        vocab = grammar.get_vocab()
-
-    memotagger = MemoTagger(postagger, tc_nouns, tc_verbs, grammar)
-    base_struct_dist = dict(grammar.base_structure_probabilities())
-    checker = BaseStructChecker(grammar)
+    With a cache (a guessing.cache.ScoreCache), passwords are looked up
+    before they are parsed and new results are added to it; call
+    cache.flush() to commit them.
+    """
+    if scorer is None:
+        scorer = Scorer(grammar, tc_nouns, tc_verbs, postagger, vocab)
 
     # optimize for ordered lists with repeated passwords
-    last_password = ""
+    last_password = None
     last_yield = None
 
-    # Build a prefix tree of the segmentations, but do not include
-    # in this tree sequences that don't occur in the grammar.
-
     for password in passwords:
+        if password != last_password:
+            last_password = password
+            last_yield = cache.get(password) if cache is not None else None
+            if last_yield is None:
+                last_yield = scorer.score(password)
+                if cache is not None:
+                    cache.put(last_yield)
 
-        if password == last_password:
-            yield last_yield
-            continue
+        yield last_yield
 
-        if password.isdigit():
-            base_struct = 'number' + str(len(password))
-            try:
-                yield (password, base_struct, base_struct_dist[base_struct])
-                continue
-            except:
-                pass
 
-        segs = deque()
-        root = PrefixTreeNode('', tag=None, p=1)
-        segs.append((root, password))
+def accepts(result, uppercase=False, camelcase=False, capitalized=False):
+    """ Returns whether the case of the password of a result of score()
+    is accepted: lowercase, or as allowed by the options.
+    """
+    password, struct, split, prob = result
 
-        # leaves = []
+    return password.islower() or \
+        uppercase and password.isupper() or \
+        camelcase and ''.join(map(str.capitalize, split)) == password or \
+        capitalized and password[0].isupper() and password[1:].islower()
 
-        max_p = 0
-        max_base_struct = None
-        max_segmentation = None
 
-        while len(segs) > 0:
-            head, tail = segs.popleft()  # head is a node, tail is a string
+def format_result(result, uppercase=False, camelcase=False, capitalized=False,
+                  print_split=False):
+    """ Returns the output line of a result of score(). """
+    password, struct, split, prob = result
 
-            for newsplit in segmenter.divide(tail):
-                if newsplit[0].lower() not in vocab: continue
+    if prob == 0:
+        return "{} {} {}\n".format(password, struct, prob)
 
-                # check if a number sequence was split
-                if newsplit[0][-1].isdigit() and \
-                        newsplit[1] and newsplit[1][0].isdigit(): continue
+    if accepts(result, uppercase, camelcase, capitalized):
+        if print_split:
+            return "{} {} {} {}\n".format(password, struct, " ".join(split), prob)
+        return "{} {} {}\n".format(password, struct, prob)
 
-                for tag, p in memotagger.get_tags(newsplit[0].lower()):
-                    # if this tag never occurs after the head tag in the grammar
-                    # then ignore this split
-                    bs = head.base_struct + '(' + tag + ')'
+    return "{} {} {}\n".format(password, None, 0)
 
-                    if not checker.exists(bs):
-                        continue
 
-                    newhead = PrefixTreeNode(newsplit[0], tag=tag, p=p)
-                    head.append_child(newhead)
+def format_parses(password, parses, uppercase=False, camelcase=False, capitalized=False,
+                  print_split=False):
+    """ Returns the output lines of the parses of a password (see
+    Scorer.parses()), one per parse whose case is accepted, or the line
+    of a password without a parse if there are none.
+    """
+    lines = [format_result(parse, uppercase, camelcase, capitalized, print_split)
+             for parse in parses if accepts(parse, uppercase, camelcase, capitalized)]
+    if not lines:
+        return format_result((password, None, None, 0))
+    return ''.join(lines)
 
-                    if newsplit[1] == '':  # success!
-                        if newhead.base_struct in base_struct_dist:
-                            p = newhead.sequence_p * base_struct_dist[newhead.base_struct]
-                            if p > max_p:
-                                max_p = p
-                                max_base_struct = newhead.base_struct
-                                max_segmentation = [node.word for node in newhead.prefix_path()]
-                                max_segmentation.reverse()
-                        # leaves.append(newhead)
-                    else:
-                        if newhead.sequence_p > max_p:
-                            segs.append((newhead, newsplit[1]))
 
-        last_password = password
-        last_yield = (password, max_base_struct, max_segmentation, max_p)
+# %% -----------------------------------------------------------------
+# parallel scoring
+
+# set in every worker by _init_worker()
+_scorer = None
+_format_options = None
+_cache = None
+_k_best = 1
 
-        yield last_yield
+
+def _init_worker(scorer, format_options, cache, k_best=1):
+    global _scorer, _format_options, _cache, _k_best
+    _scorer = scorer
+    _format_options = format_options
+    _cache = cache
+    _k_best = k_best
+
+
+def _score_chunk(chunk):
+    """ Returns the number of passwords, the output and the numbers of
+    cache hits and misses of a chunk.
+    """
+    if _k_best > 1:
+        output = ''.join(format_parses(password, _scorer.parses(password, _k_best),
+                                       **_format_options) for password in chunk)
+        return len(chunk), output, 0, 0
+
+    hits, misses = (_cache.hits, _cache.misses) if _cache is not None else (0, 0)
+
+    results = score(chunk, None, None, None, scorer=_scorer, cache=_cache)
+    output = ''.join(format_result(r, **_format_options) for r in results)
+
+    if _cache is None:
+        return len(chunk), output, 0, 0
+    _cache.flush()
+    return len(chunk), output, _cache.hits - hits, _cache.misses - misses
+
+
+def read_chunks(lines, skip=0, chunk_size=10000):
+    """ Yields lists of up to chunk_size passwords, one per line, after
+    skipping the first skip lines.
+    """
+    lines = islice(lines, skip, None)
+    while True:
+        chunk = [line.rstrip() for line in islice(lines, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def score_chunks(chunks, scorer, format_options, num_workers=1, cache=None, k_best=1):
+    """ Scores chunks of passwords, yielding for every chunk, in input order,
+    a tuple (number of passwords, output). Workers are forked after the
+    scorer is built, so they share the grammar, tree cuts and tagger; at
+    most 2 * num_workers chunks are in flight. The hits and misses of the
+    workers are added to the statistics of cache. With k_best > 1, the
+    output has a line for each of the k_best most probable parses of a
+    password (see format_parses()), and cache isn't used.
+    """
+    if num_workers <= 1:
+        _init_worker(scorer, format_options, cache, k_best)
+        for chunk in chunks:
+            yield _score_chunk(chunk)[:2]
+        return
+
+    def collect(result):
+        n, output, hits, misses = result.get()
+        if cache is not None:
+            cache.hits += hits
+            cache.misses += misses
+        return n, output
+
+    with Pool(num_workers, initializer=_init_worker,
+              initargs=(scorer, format_options, cache, k_best)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_score_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                yield collect(pending.popleft())
+        while pending:
+            yield collect(pending.popleft())
+
+
+# %% -----------------------------------------------------------------
+# duplicate elimination
+
+
+def tally(lines, partitions=1, tmp_dir=None):
+    """ Counts the passwords of lines (one per line), yielding a Counter
+    per partition. With partitions > 1, passwords are first spread over that
+    many temporary files by hash, so only one partition is held in memory at
+    a time; a password is always in a single partition.
+    """
+    if partitions <= 1:
+        yield Counter(line.rstrip() for line in lines)
+        return
+
+    files = [tempfile.TemporaryFile('w+', dir=tmp_dir, encoding='utf-8',
+                                    errors='surrogateescape', newline='\n')
+             for _ in range(partitions)]
+    for line in lines:
+        password = line.rstrip()
+        files[hash(password) % partitions].write(password + '\n')
+
+    for f in files:
+        f.seek(0)
+        yield Counter(line[:-1] for line in f)
+        f.close()
+
+
+def score_unique(passwords, scorer, format_options, num_workers=1, cache=None,
+                 chunk_size=10000):
+    """ Scores distinct passwords (see score_chunks()), yielding tuples
+    (password, output line without the newline).
+    """
+    passwords = list(passwords)
+    chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+
+    for chunk, (_, output) in zip(chunks, score_chunks(iter(chunks), scorer, format_options,
+                                                       num_workers, cache)):
+        yield from zip(chunk, output.split('\n'))
+
+
+def score_aggregate(lines, out, scorer, format_options, num_workers=1, cache=None,
+                    chunk_size=10000, partitions=1):
+    """ Writes one line per distinct password: its number of occurrences,
+    a tab and its output line. Passwords are in no particular order.
+    """
+    for counts in tally(lines, partitions):
+        for password, line in score_unique(sorted(counts), scorer, format_options,
+                                           num_workers, cache, chunk_size):
+            out.write("{}\t{}\n".format(counts[password], line))
+
+
+def score_deduplicated(lines, out, scorer, format_options, num_workers=1, cache=None,
+                       chunk_size=10000):
+    """ Writes the output lines of lines in input order, scoring every
+    distinct password once. The input is read twice (spooled to a temporary
+    file if it can't seek), and the output lines of the distinct passwords
+    are kept in memory.
+    """
+    if not lines.seekable():
+        spool = tempfile.TemporaryFile('w+', encoding='utf-8', errors='surrogateescape',
+                                       newline='\n')
+        shutil.copyfileobj(lines, spool)
+        lines = spool
+
+    lines.seek(0)
+    counts = next(tally(lines))
+    scored = dict(score_unique(counts, scorer, format_options, num_workers, cache, chunk_size))
+
+    lines.seek(0)
+    for line in lines:
+        out.write(scored[line.rstrip()] + '\n')
 
 
 # %%------------------------------------------------------------------
@@ -403,7 +673,31 @@ def options():
                         action='store_true',
                         help='produce a match even when a password is capitalized')
     parser.add_argument('--print_split', action='store_true')
-    parser.add_argument('--session_name')
+    parser.add_argument('-k', '--k_best', type=int, default=1,
+                        help='output the k most probable parses of every '
+                             'password, one per line')
+    parser.add_argument('--session_name',
+                        help='save progress after every chunk, and resume '
+                             'from the last saved chunk of the session')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+                        help='number of cores available for parallel work')
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help='number of passwords scored at once by a worker')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='score every distinct password once, and output '
+                             'in input order')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='output one line per distinct password, prefixed '
+                             'by its number of occurrences and a tab')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='with --aggregate, count the passwords in this '
+                             'many partitions, one in memory at a time')
+    parser.add_argument('--cache', default=None,
+                        help='an SQLite file of scores to reuse across runs '
+                             '(created if missing)')
+    parser.add_argument('--cache_size', type=int, default=None,
+                        help='maximum number of scores in the cache (the '
+                             'oldest are removed first)')
 
     return parser.parse_args()
 
@@ -413,16 +707,29 @@ if __name__ == '__main__':
     grammar_dir = Path(opts.grammar_dir)
     passwords_file = opts.passwords
 
-    accept_upper = opts.uppercase
-    accept_camel = opts.camelcase
-    accept_capital = opts.capitalized
+    format_options = dict(uppercase=opts.uppercase,
+                          camelcase=opts.camelcase,
+                          capitalized=opts.capitalized,
+                          print_split=opts.print_split)
 
     session_name = opts.session_name
-
-    postagger = ExhaustiveTagger.from_pickle()
-    tc_nouns = pickle.load(open(grammar_dir / 'noun_treecut.pickle', 'rb'))
-    tc_verbs = pickle.load(open(grammar_dir / 'verb_treecut.pickle', 'rb'))
-    grammar = model.Grammar.from_files(opts.grammar_dir)
+    if session_name and (opts.dedupe or opts.aggregate):
+        raise SystemExit("--session_name can't be used with --dedupe or --aggregate")
+    if opts.k_best > 1 and (opts.dedupe or opts.aggregate or opts.cache):
+        raise SystemExit("--k_best can't be used with --dedupe, --aggregate or --cache")
+    if opts.partitions > 1 and not opts.aggregate:
+        raise SystemExit("--partitions can only be used with --aggregate")
+
+    grammar = model.Grammar.from_files(opts.grammar_dir, lazy=True)
+
+    if (grammar_dir / 'word_tags.bin').exists():
+        word_tags = storage.WordTags(str(grammar_dir / 'word_tags.bin'), grammar)
+        scorer = Scorer(grammar, None, None, word_tags=word_tags)
+    else:
+        postagger = ExhaustiveTagger.from_pickle()
+        tc_nouns = pickle.load(open(grammar_dir / 'noun_treecut.pickle', 'rb'))
+        tc_verbs = pickle.load(open(grammar_dir / 'verb_treecut.pickle', 'rb'))
+        scorer = Scorer(grammar, tc_nouns, tc_verbs, postagger)
 
     skip = 0
     if session_name:
@@ -430,41 +737,37 @@ if __name__ == '__main__':
         if progress:
             skip = int(progress['n_processed'])
 
-    passwords = (line.rstrip() for i, line in enumerate(passwords_file) if i >= skip)
+    cache = None
+    if opts.cache:
+        cache = ScoreCache(opts.cache, fingerprint(opts.grammar_dir), opts.cache_size)
 
     n_processed = skip
     completed = False
 
-    # noinspection PyBroadException
     try:
-        for password, struct, split, prob in score(passwords, grammar,
-                                                   tc_nouns, tc_verbs, postagger, grammar.get_vocab()):
-
-            if prob == 0:
-                print(password, struct, prob)
-                continue
-
-            if password.islower() or \
-                    accept_upper and password.isupper() or \
-                    accept_camel and ''.join(map(str.capitalize, split)) == password or \
-                    accept_capital and password[0].isupper() and password[1:].islower():
-
-                if opts.print_split:
-                    print(password, struct, " ".join(split), prob)
-                else:
-                    print(password, struct, prob)
-
-            else:
-                print(password, None, 0)
-
-            n_processed += 1
+        if opts.aggregate:
+            score_aggregate(passwords_file, sys.stdout, scorer, format_options,
+                            opts.num_workers, cache, opts.chunk_size, opts.partitions)
+        elif opts.dedupe:
+            score_deduplicated(passwords_file, sys.stdout, scorer, format_options,
+                               opts.num_workers, cache, opts.chunk_size)
+        else:
+            chunks = read_chunks(passwords_file, skip, opts.chunk_size)
+            for n, output in score_chunks(chunks, scorer, format_options, opts.num_workers, cache,
+                                          opts.k_best):
+                sys.stdout.write(output)
+                n_processed += n
 
-            if session_name and n_processed % 10000 == 0:
-                save_progress(session_name, n_processed)
+                if session_name:
+                    sys.stdout.flush()  # progress never runs ahead of the output
+                    save_progress(session_name, n_processed)
 
         completed = True
-    except BaseException:
+    except KeyboardInterrupt:
         pass
     finally:
         if session_name:
             save_progress(session_name, n_processed, completed)
+        if cache is not None:
+            cache.close()
+            sys.stderr.write("Score cache: {hits} hits, {misses} misses\n".format(**cache.stats()))
@@ -0,0 +1,378 @@
+"""
+A resident scoring service: keeps a grammar loaded (with its tagger and tree
+cuts, or its word_tags table, see guessing.word_tags) and scores passwords
+sent over HTTP, on a TCP port or a Unix socket. Built on asyncio; passwords
+are scored by worker processes forked after the grammar is loaded.
+
+API (JSON):
+
+    POST /score  {"password": "..."} or {"passwords": ["...", ...]}
+        -> {"results": [{"password", "p", "base_struct", "segmentation",
+                         "guess_number"}, ...]}
+    GET /stats
+        -> numbers of requests and passwords, and latency histograms
+
+guess_number is null unless the service was given a scored sample of the
+grammar (see guessing.strength), or when p is 0.
+
+Usage:
+    python -m guessing.service grammar_dir --sample scored_sample.txt --port 8080
+    python -m guessing.service grammar_dir --unix /tmp/scorer.sock -w 4
+"""
+import argparse
+import asyncio
+import json
+import pickle
+import sys
+import time
+
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from pathlib import Path
+
+from guessing.score import Scorer
+from guessing.strength import StrengthEstimator
+from learning import model, storage
+from learning.pos import ExhaustiveTagger
+
+# set in every worker by _init_worker()
+_scorer = None
+
+
+def _init_worker(scorer):
+    global _scorer
+    _scorer = scorer
+
+
+def _score_batch(passwords):
+    """ Returns a list of tuples (result of Scorer.score(), seconds). """
+    results = []
+    for password in passwords:
+        start = time.perf_counter()
+        result = _scorer.score(password)
+        results.append((result, time.perf_counter() - start))
+    return results
+
+
+class LatencyHistogram(object):
+    """ Counts of latencies in buckets with fixed upper bounds (ms). """
+
+    BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # the last one is unbounded
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(self.BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+
+    def quantile(self, q):
+        """ Returns the upper bound of the bucket of the q-quantile (None
+        if empty or beyond the last bound).
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else None,
+            'p50_ms': self.quantile(0.5),
+            'p90_ms': self.quantile(0.9),
+            'p99_ms': self.quantile(0.99),
+            'buckets': [[bound, count] for bound, count in zip(self.BOUNDS, self.counts)]
+                       + [['+Inf', self.counts[-1]]]
+        }
+
+
+class BadRequest(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ScoringService(object):
+    """ Serves the scores of a Scorer over HTTP.
+
+    Args:
+        scorer - a guessing.score.Scorer
+        estimator - a guessing.strength.StrengthEstimator, for guess numbers
+        num_workers - number of processes scoring passwords (with 1, a
+            thread scores them, so the event loop keeps serving requests)
+        max_batch - maximum number of passwords in a request
+        max_body - maximum size of a request body, in bytes
+    """
+
+    def __init__(self, scorer, estimator=None, num_workers=1, max_batch=10000,
+                 max_body=1 << 20):
+        self.scorer = scorer
+        self.estimator = estimator
+        self.num_workers = num_workers
+        self.max_batch = max_batch
+        self.max_body = max_body
+
+        if num_workers > 1:
+            self.executor = ProcessPoolExecutor(num_workers, initializer=_init_worker,
+                                                initargs=(scorer,))
+        else:
+            self.executor = ThreadPoolExecutor(1, initializer=_init_worker, initargs=(scorer,))
+
+        self.requests = 0
+        self.passwords = 0
+        self.errors = 0
+        self.histograms = {'request': LatencyHistogram(),  # POST /score, end to end
+                           'password': LatencyHistogram()}  # parsing one password
+
+    async def score(self, passwords):
+        """ Returns the results of a list of passwords, as dicts. """
+        loop = asyncio.get_running_loop()
+
+        size = -(-len(passwords) // self.num_workers) or 1
+        batches = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+        scored = await asyncio.gather(*[loop.run_in_executor(self.executor, _score_batch, batch)
+                                        for batch in batches])
+
+        results = []
+        for (password, base_struct, segmentation, p), seconds in (r for b in scored for r in b):
+            self.histograms['password'].add(seconds)
+            guess_number = None
+            if self.estimator is not None and p > 0:
+                guess_number = self.estimator.guess_number(p)
+            results.append({'password': password, 'p': p, 'base_struct': base_struct,
+                            'segmentation': segmentation, 'guess_number': guess_number})
+        self.passwords += len(passwords)
+        return results
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'passwords': self.passwords,
+            'errors': self.errors,
+            'latency': {name: h.to_dict() for name, h in self.histograms.items()}
+        }
+
+    async def _route(self, method, target, body):
+        if target == '/score':
+            if method != 'POST':
+                raise BadRequest(405, "use POST")
+            try:
+                request = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise BadRequest(400, "the body isn't JSON")
+            if not isinstance(request, dict):
+                raise BadRequest(400, "expected a JSON object")
+
+            passwords = [request['password']] if 'password' in request else request.get('passwords')
+            if not isinstance(passwords, list) or not all(isinstance(p, str) for p in passwords):
+                raise BadRequest(400, "expected a password or a list of passwords")
+            if len(passwords) > self.max_batch:
+                raise BadRequest(413, "at most {} passwords per request".format(self.max_batch))
+
+            start = time.perf_counter()
+            results = await self.score(passwords)
+            self.histograms['request'].add(time.perf_counter() - start)
+            self.requests += 1
+            return {'results': results}
+
+        if target == '/stats':
+            if method != 'GET':
+                raise BadRequest(405, "use GET")
+            return self.stats()
+
+        raise BadRequest(404, "unknown path {}".format(target))
+
+    async def _respond(self, writer, status, response):
+        data = json.dumps(response).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                     'Content-Length: {}\r\n\r\n'
+                     .format(status, HTTPStatus(status).phrase, len(data))
+                     .encode('latin-1') + data)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """ Serves the requests of a connection (HTTP/1.1, keep-alive).
+        Requests that can't be framed (a malformed or too long request line,
+        header or Content-Length) get a 400 response, and bodies longer than
+        max_body a 413 response before they are read; both close the
+        connection.
+        """
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                    if not line:
+                        break
+
+                    headers = dict()
+                    while True:
+                        header = await reader.readline()
+                        if header in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = header.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+
+                    method, target, _ = line.decode('latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:  # also raised by readline() past the limit of the reader
+                    self.errors += 1
+                    await self._respond(writer, 400, {'error': "malformed request"})
+                    break
+
+                if length > self.max_body:
+                    self.errors += 1
+                    await self._respond(writer, 413, {'error': "the body is longer than {} bytes"
+                                                               .format(self.max_body)})
+                    break
+
+                body = await reader.readexactly(length)
+
+                try:
+                    status, response = 200, await self._route(method, target, body)
+                except BadRequest as e:
+                    self.errors += 1
+                    status, response = e.status, {'error': str(e)}
+                except Exception as e:
+                    self.errors += 1
+                    sys.stderr.write("Error serving {} {}: {!r}\n".format(method, target, e))
+                    status, response = 500, {'error': "internal error"}
+
+                await self._respond(writer, status, response)
+
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080, path=None):
+        """ Returns an asyncio Server, listening on a Unix socket at path, or
+        on host and port.
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path=path)
+        return await asyncio.start_server(self.handle, host=host, port=port)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ScoringClient(object):
+    """ A minimal client of ScoringService (one connection per request). """
+
+    def __init__(self, host='127.0.0.1', port=8080, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+
+    async def request(self, method, target, body=None):
+        """ Returns the status and the (decoded) JSON response. """
+        if self.path is not None:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n'
+                     'Content-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                     .format(method, target, self.host, len(data)).encode('latin-1') + data)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while True:
+            header = await reader.readline()
+            if header in (b'\r\n', b''):
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        response = json.loads((await reader.readexactly(length)).decode('utf-8'))
+
+        writer.close()
+        await writer.wait_closed()
+        return status, response
+
+    async def score(self, passwords):
+        """ Returns the list of results of a list of passwords. """
+        status, response = await self.request('POST', '/score', {'passwords': passwords})
+        if status != 200:
+            raise RuntimeError(response.get('error'))
+        return response['results']
+
+    async def stats(self):
+        return (await self.request('GET', '/stats'))[1]
+
+
+def load_scorer(grammar_dir):
+    """ Returns a Scorer of a grammar folder, using its word_tags table if
+    it has one.
+    """
+    grammar_dir = Path(grammar_dir)
+    grammar = model.Grammar.from_files(str(grammar_dir), lazy=True)
+
+    if (grammar_dir / 'word_tags.bin').exists():
+        word_tags = storage.WordTags(str(grammar_dir / 'word_tags.bin'), grammar)
+        return Scorer(grammar, None, None, word_tags=word_tags)
+
+    postagger = ExhaustiveTagger.from_pickle()
+    tc_nouns = pickle.load(open(grammar_dir / 'noun_treecut.pickle', 'rb'))
+    tc_verbs = pickle.load(open(grammar_dir / 'verb_treecut.pickle', 'rb'))
+    return Scorer(grammar, tc_nouns, tc_verbs, postagger)
+
+
+def options():
+    parser = argparse.ArgumentParser(description='Keep a grammar loaded and '
+                                     'score passwords sent over HTTP.')
+    parser.add_argument('grammar_dir')
+    parser.add_argument('--sample', type=argparse.FileType('r'), default=None,
+                        help='a scored sample of the grammar, to estimate '
+                             'guess numbers (see guessing.strength)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', default=None,
+                        help='listen on a Unix socket at this path instead')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+                        help='number of cores available for parallel work')
+    parser.add_argument('--max_batch', type=int, default=10000,
+                        help='maximum number of passwords per request')
+    parser.add_argument('--max_body', type=int, default=1 << 20,
+                        help='maximum size of a request body, in bytes')
+    return parser.parse_args()
+
+
+async def main(opts):
+    scorer = load_scorer(opts.grammar_dir)
+    estimator = StrengthEstimator.from_sample(opts.sample) if opts.sample else None
+
+    service = ScoringService(scorer, estimator, opts.num_workers, opts.max_batch, opts.max_body)
+    server = await service.start(opts.host, opts.port, opts.unix)
+    sys.stderr.write("Serving on {}\n".format(opts.unix or '{}:{}'.format(opts.host, opts.port)))
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main(options()))
+    except KeyboardInterrupt:
+        pass
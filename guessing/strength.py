@@ -83,6 +83,39 @@ def read_sample(f):
                        quoting=3)
 
 
+class StrengthEstimator(object):
+    """ Estimates the guess number of a password from its probability and
+    a sample of the grammar: the number of passwords output before it when
+    the grammar's language is output in decreasing order of probability
+    (Section 3.2 in Dell'Amico and Filippone (2015)).
+    """
+
+    def __init__(self, probs, multiplier=1):
+        probs = np.sort(np.asarray(probs, dtype=np.float64))[::-1]
+        strengths = np.cumsum(1 / probs) / len(probs)
+
+        # in ascending order of probability, for binary search
+        self.probs = probs[::-1]
+        self.strengths = strengths[::-1]
+        self.multiplier = multiplier
+
+    @classmethod
+    def from_sample(cls, f, dedupe=False, multiplier=1):
+        """ Reads a sample (see read_sample()), dropping duplicate passwords
+        if dedupe is True.
+        """
+        sample = read_sample(f)
+        if dedupe:
+            sample = sample.drop_duplicates("password")
+        return cls(sample['p'].dropna().values, multiplier)
+
+    def guess_number(self, p):
+        # index of the lowest probability higher than p
+        i = np.searchsorted(self.probs, p, side='left')
+        i = min(max(i + 1, 0), len(self.probs) - 1)
+        return float(self.strengths[i]) * self.multiplier
+
+
 def password_score_iterator(password_file, grammar_path):
     if grammar_path is None:
         for line in password_file:
@@ -98,7 +131,7 @@ def password_score_iterator(password_file, grammar_path):
 
         tc_nouns = pickle.load(open(grammar_dir / 'noun_treecut.pickle', 'rb'))
         tc_verbs = pickle.load(open(grammar_dir / 'verb_treecut.pickle', 'rb'))
-        grammar = model.Grammar.from_files(grammar_path)
+        grammar = model.Grammar.from_files(grammar_path, lazy=True)
 
         return score((line.lower().rstrip() for line in password_file),
                      grammar, tc_nouns, tc_verbs)
@@ -107,28 +140,7 @@ def password_score_iterator(password_file, grammar_path):
 def main():
     opts = options()
 
-    multiplier = opts.multiplier
-
-    sample = read_sample(opts.sample)  # a pandas frame
-    # drop duplicates
-    if opts.dedupe:
-        sample = sample.drop_duplicates("password")
-
-    # load sample, sort it and compute cumulative probability
-    sample = sample.sort_values('p', ascending=False)
-
-    # compute the estimated number of passwords output before this one in a
-    # process where the grammar's language is output in highest probability order
-    # see Session 3.2 in Dell'Amico and Filippone (2015)
-    n = len(sample)
-    sample['strength'] = (1 / sample['p']).cumsum() * 1 / n
-
-    # now sort it ascending, cause that's the only way binary search
-    # will work in pandas (asc p is desc strength)
-    sample = sample.sort_values('strength', ascending=False)
-
-    # restore index
-    sample = sample.reset_index().drop("index", axis=1)
+    estimator = StrengthEstimator.from_sample(opts.sample, opts.dedupe, opts.multiplier)
 
     for password, struct, p in password_score_iterator(opts.passwords, opts.grammar):
         if p == 0:  # password isn't guessed by this grammar
@@ -136,13 +148,7 @@ def main():
                 sys.stdout.write("{}\t{:.2f}\n".format(password, 0))
             continue
 
-        # find bisector (index where elements should be inserted to maintain order)
-        # invert Dellamico's 3.2 instruction since our array is in ascending order
-        bisector = sample['p'].searchsorted(p, side='left')  # note left
-
-        bisector = min(max(bisector + 1, 0), n - 1)  # index of the lowest prob. higher than p
-
-        strength = sample['strength'][bisector] * multiplier
+        strength = estimator.guess_number(p)
 
         sys.stdout.write("{}\t{:.2f}\n".format(password, strength))
 
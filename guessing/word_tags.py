@@ -0,0 +1,73 @@
+"""
+Precomputes the tags of every terminal of a grammar, as found by the tagger
+of the scorer (POS tagger, WordNet and tree cuts), with their probabilities,
+and stores them in the grammar folder (word_tags.bin). guessing.score then
+reads them from the table and loads neither the tagger nor WordNet.
+
+The table belongs to the grammar it was built from: writing the grammar
+folder again (e.g., learning.prune) removes it.
+
+Usage:
+    python -m guessing.word_tags grammar_dir -w 4
+"""
+import argparse
+import os
+import pickle
+
+from multiprocessing import Pool
+
+from guessing.score import MemoTagger
+from learning import model, storage
+from learning.pos import ExhaustiveTagger
+
+# set in every worker by _init_worker()
+_memotagger = None
+
+
+def _init_worker(memotagger):
+    global _memotagger
+    _memotagger = memotagger
+
+
+def _tag_words(words):
+    return [(word, sorted(_memotagger.get_tags(word))) for word in words]
+
+
+def word_tags(grammar, memotagger, num_workers=1, chunk_size=1000):
+    """ Returns a dict: terminal -> list of tuples (tag, p), for the whole
+    vocabulary of a grammar.
+    """
+    words = list(grammar.vocabulary())
+    chunks = [words[i:i + chunk_size] for i in range(0, len(words), chunk_size)]
+
+    if num_workers > 1:
+        with Pool(num_workers, initializer=_init_worker, initargs=(memotagger,)) as pool:
+            results = pool.map(_tag_words, chunks)
+    else:
+        _init_worker(memotagger)
+        results = map(_tag_words, chunks)
+
+    return dict(pair for result in results for pair in result)
+
+
+def options():
+    parser = argparse.ArgumentParser(description='Precompute the tags of the '
+                                     'vocabulary of a grammar for guessing.score.')
+    parser.add_argument('grammar_dir')
+    parser.add_argument('-w', '--num_workers', type=int, default=1,
+                        help='number of cores available for parallel work')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts = options()
+
+    postagger = ExhaustiveTagger.from_pickle()
+    tc_nouns = pickle.load(open(os.path.join(opts.grammar_dir, 'noun_treecut.pickle'), 'rb'))
+    tc_verbs = pickle.load(open(os.path.join(opts.grammar_dir, 'verb_treecut.pickle'), 'rb'))
+    grammar = model.Grammar.from_files(opts.grammar_dir, lazy=True)
+
+    memotagger = MemoTagger(postagger, tc_nouns, tc_verbs, grammar)
+    table = word_tags(grammar, memotagger, opts.num_workers)
+
+    storage.write_word_tags(os.path.join(opts.grammar_dir, 'word_tags.bin'), table)
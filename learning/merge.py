@@ -0,0 +1,231 @@
+"""
+Merges grammars (e.g., one per leak) into a mixture model.
+
+The counts of every grammar are scaled by its mixture weight and added up,
+one base structure and one tag at a time. Grammars stored with a grammar.bin
+are read a tag at a time. Grammars trained with different tree cuts are
+translated to common (target) tree cuts first, mapping each semantic class
+through the synsets it covers (see ClassMapper).
+
+A base structure maps to the product of the classes of its tags, which grows
+multiplicatively with the number of semantic tags. merge() keeps at most
+max_mapped of them per base structure (the most probable, with the count of
+the structure spread over them), so merging takes time linear in the total
+size of the grammars.
+
+Usage:
+    python -m learning.merge merged_dir grammar1 grammar2 --weights 0.7 0.3
+
+"""
+
+import argparse
+import os
+import pickle
+
+from collections import defaultdict
+from heapq import heappop, heappush
+from itertools import product
+
+from learning.model import Grammar
+
+
+class ClassMapper(object):
+    """ Maps the classes (tags) of a grammar to the classes of target tree
+    cut models. A class is a node of the WordNet tree; it maps to the target
+    classes that cover its leaves (synsets), each weighted by the share of
+    leaves it covers. Tags that aren't classes, e.g., POS tags and numberN,
+    map to themselves. With tagtype 'pos_semantic', the POS prefix is kept.
+    """
+
+    def __init__(self, tcm_n, tcm_v):
+        self.treecuts = []  # (key -> nodes, cut) of every tree
+        for tcm in (tcm_n, tcm_v):
+            if tcm is not None:
+                self.treecuts.append((tcm.treecut.tree.hashtable(), tcm.treecut))
+        self.cache = dict()
+
+    def _map_class(self, key):
+        for nodes, treecut in self.treecuts:
+            if key not in nodes:
+                continue
+
+            leaves = set(leaf.key for node in nodes[key] for leaf in node.leaves())
+            classes = defaultdict(float)
+            for leaf in leaves:
+                targets = treecut.abstract(leaf) or []
+                for target in targets:
+                    classes[target.key] += 1 / len(targets) / len(leaves)
+
+            if classes:
+                return list(classes.items())
+
+        return None
+
+    def __call__(self, tag):
+        """ Returns a list of tuples (target tag, weight). """
+        try:
+            return self.cache[tag]
+        except KeyError:
+            pass
+
+        classes = self._map_class(tag)
+
+        if classes is None and '_' in tag:  # pos_semantic: pos_class
+            pos, key = tag.split('_', 1)
+            classes = self._map_class(key)
+            if classes is not None:
+                classes = [(pos + '_' + c, w) for c, w in classes]
+
+        self.cache[tag] = classes or [(tag, 1.0)]
+        return self.cache[tag]
+
+
+def _terminals(grammar, tag):
+    """ Iterates over the (terminal, count) pairs of a tag, without keeping
+    the terminals of a stored grammar in memory.
+    """
+    tag_dicts = grammar.tag_dicts
+    if hasattr(tag_dicts, 'terminals'):  # a storage.GrammarView
+        return tag_dicts.terminals(tag)
+    return tag_dicts[tag].items()
+
+
+def _top_products(options, n):
+    """ Returns up to n of the most probable combinations of options (one
+    tuple (tag, weight) per list), as lists, with their weights rescaled to
+    add up to the weight of all combinations.
+    """
+    size = 1
+    for o in options:
+        size *= len(o)
+    if n is None or size <= n:
+        return [list(mapped) for mapped in product(*options)]
+
+    options = [sorted(o, key=lambda x: -x[1]) for o in options]
+
+    def weight(indices):
+        w = 1.0
+        for o, i in zip(options, indices):
+            w *= o[i][1]
+        return w
+
+    # best-first over the indices of the sorted options
+    start = (0,) * len(options)
+    heap = [(-weight(start), start)]
+    seen = {start}
+    top = []
+    while heap and len(top) < n:
+        _, indices = heappop(heap)
+        top.append(indices)
+        for k in range(len(options)):
+            if indices[k] + 1 < len(options[k]):
+                succ = indices[:k] + (indices[k] + 1,) + indices[k + 1:]
+                if succ not in seen:
+                    seen.add(succ)
+                    heappush(heap, (-weight(succ), succ))
+
+    total = 1.0
+    for o in options:
+        total *= sum(w for _, w in o)
+    kept = sum(weight(indices) for indices in top)
+
+    result = []
+    for indices in top:
+        mapped = [o[i] for o, i in zip(options, indices)]
+        mapped[0] = (mapped[0][0], mapped[0][1] * total / kept)
+        result.append(mapped)
+    return result
+
+
+def merge(grammars, weights=None, mapper=None, max_mapped=100):
+    """
+    Returns a Grammar that is a mixture of grammars.
+
+    Args:
+        grammars - a list of Grammars with the same tagtype and estimator
+        weights - mixture weights, one per grammar. If None, every grammar
+            weighs as much as its number of observations, as if it were
+            trained on the concatenation of the password lists.
+        mapper - a ClassMapper, to translate the classes of every grammar
+            to common tree cuts (None to merge tags as they are)
+        max_mapped - maximum number of base structures a base structure
+            maps to (None for all of them)
+    """
+    first = grammars[0]
+    for grammar in grammars[1:]:
+        if (grammar.tagtype, grammar.estimator) != (first.tagtype, first.estimator):
+            raise ValueError("grammars with different tagtypes or estimators")
+
+    sizes = [sum(grammar.base_structures.values()) for grammar in grammars]
+    if weights is None:
+        scales = [1] * len(grammars)
+    else:
+        total_weight = sum(weights)
+        scales = [w / total_weight * sum(sizes) / size for w, size in zip(weights, sizes)]
+
+    if mapper is None:
+        mapper = lambda tag: [(tag, 1.0)]
+
+    merged = Grammar(tagtype=first.tagtype, estimator=first.estimator)
+    merged.lowres = first.lowres
+
+    for grammar, scale in zip(grammars, scales):
+        for struct, count in grammar.base_structures.items():
+            options = [mapper(tag) for tag in grammar.struct_tags(struct)]
+            for mapped in _top_products(options, max_mapped):
+                weight = scale
+                for _, w in mapped:
+                    weight *= w
+                merged._add_base_structure([tag for tag, _ in mapped], count * weight)
+                merged.counter += count * weight
+
+        for tag in list(grammar.tag_dicts.keys()):
+            for target, w in mapper(tag):
+                tag_dict = merged.tag_dicts[target]
+                for word, count in _terminals(grammar, tag):
+                    tag_dict[word] += count * scale * w
+
+    merged._invalidate()
+
+    return merged
+
+
+def options():
+    parser = argparse.ArgumentParser(description='Merge grammars into a '
+                                     'mixture model.')
+    parser.add_argument('output_dir', help='a folder to store the merged grammar')
+    parser.add_argument('grammar_dirs', nargs='+')
+    parser.add_argument('--weights', type=float, nargs='+', default=None,
+                        help='mixture weights, one per grammar (default: '
+                             'proportional to the number of passwords)')
+    parser.add_argument('--treecuts', default=None,
+                        help='the grammar whose tree cuts the merged grammar '
+                             'adopts (default: the first one)')
+    parser.add_argument('--max_mapped', type=int, default=100,
+                        help='maximum number of base structures a base '
+                             'structure maps to in the target tree cuts')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts = options()
+
+    if opts.weights and len(opts.weights) != len(opts.grammar_dirs):
+        raise SystemExit("expected one weight per grammar")
+
+    grammars = [Grammar.from_files(d, lazy=True) for d in opts.grammar_dirs]
+
+    treecut_dir = opts.treecuts or opts.grammar_dirs[0]
+    treecuts = dict()
+    for name in ('noun_treecut.pickle', 'verb_treecut.pickle'):
+        path = os.path.join(treecut_dir, name)
+        treecuts[name] = pickle.load(open(path, 'rb')) if os.path.exists(path) else None
+
+    mapper = None
+    if grammars[0].tagtype != 'pos':
+        mapper = ClassMapper(treecuts['noun_treecut.pickle'], treecuts['verb_treecut.pickle'])
+
+    merged = merge(grammars, opts.weights, mapper, opts.max_mapped)
+
+    merged.write_to_disk(opts.output_dir,
+                         pickles={name: tcm for name, tcm in treecuts.items() if tcm is not None})
@@ -1,12 +1,13 @@
 from learning.tree.wordnet import IndexedWordNetTree
 from learning.tree.default_tree import TreeCut
 from learning.tree.cut import wagner, li_abe
-from collections import defaultdict, Counter
+from collections import defaultdict, deque, Counter
+from array import array
+from bisect import bisect_left
 from multiprocessing import Process, Manager, Pool, Queue
 
 from misc import util
 
-import shutil
 import re
 import os
 import sys
@@ -41,30 +42,30 @@ class TreeCutModel():
           self
         """
         pos = self.pos
-        specificity = self.specificity
 
         self.tree = tree = IndexedWordNetTree(pos)
+        leaf_counts = np.zeros(len(tree.leaf_nodes))
         for synset, count in X:
             if synset.pos() == pos:
-                self._increment_synset_count(synset, count)
-        tree.updateCounts()
+                self._increment_synset_count(leaf_counts, synset, count)
 
-        N = tree.root.value
-        if self.estimator == 'mle':
-            estimator = MleEstimator(N)
-        else:
-            k = tree.root.leaf_count
-            estimator = LaplaceEstimator(N, k, 1)
+        tree.set_leaf_values(leaf_counts)
+        tree.updateCounts()
 
-        if specificity:
-            cut = wagner.findcut(tree, specificity, estimator)
-        else:
-            cut = li_abe.findcut(tree, estimator)
+        self.fit_tree(tree)
 
-        self.treecut = TreeCut(tree, cut)
+        return self
 
     def fit_tree(self, tree):
-        pos = self.pos
+        """ Fit a tree cut model to a tree whose counts are up to date.
+
+        Subtrees with zero counts are collapsed before the search (see
+        WordNetTree.collapsed()). This does not change the cut: for such a
+        subtree, the description length of the cut made of its root alone
+        is 0 (no data, no parameters), while any other cut of the subtree
+        has a non-negative description length, so both li_abe and wagner
+        always choose the root (they prefer the parent on ties).
+        """
         specificity = self.specificity
         self.tree = tree
 
@@ -75,10 +76,15 @@ class TreeCutModel():
             k = tree.root.leaf_count
             estimator = LaplaceEstimator(N, k, 1)
 
+        search_tree = tree.collapsed()
+
         if specificity:
-            cut = wagner.findcut(tree, specificity, estimator)
+            cut = wagner.findcut(search_tree, specificity, estimator)
         else:
-            cut = li_abe.findcut(tree, estimator)
+            cut = li_abe.findcut(search_tree, estimator)
+
+        # map the cut back to the nodes of the full tree
+        cut = [node.origin for node in cut]
 
         self.treecut = TreeCut(tree, cut)
 
@@ -109,38 +115,20 @@ class TreeCutModel():
 
         return labels
 
-    def _increment_synset_count(self, synset, count=1):
-        """ Given  a  WordNetTree, increases the  count  (frequency)
-        of a  synset (does not propagate to its ancestors). This
-        method is more efficient than WordNetTree.increment_synset()
-        as it uses WordNetTree.hashtable() to avoid searching.
-
-        It's different  from increment_node() in that it  increments
-        the counts of ALL nodes  matching a key. In fact, it divides
-        the count by the number of nodes matching the key.
-        increment_node() resolves  ambiguity using the ancestor path
-        received as argument.
-        """
-        index = self.tree.index
-        paths = synset.hypernym_paths()
-
-        key = synset.name()
-
-        if key in index and len(index[key]) == len(paths):
-            count = float(count) / len(paths)
-            nodes = index[key]
-            for n in nodes:
-                if n.has_children():
-                    n = n.find('s.' + n.key)
-                n.increment_value(count, cumulative=False)
-        else:
-            # this block used to exist because WordNetTree.load used a method
-            # (depth search) that missed a few synsets (it's a nltk.wordnet bug)
-            # the line below would insert the synset in the tree
-            # I kept this line just in case there is problem with WordNetTree
-            # coverage
-            print(synset, count)
-            self.tree.increment_synset(synset, count, cumulative=False)
+    def _increment_synset_count(self, leaf_counts, synset, count=1):
+        """ Increases the count (frequency) of a synset in an array of
+        leaf counts aligned with self.tree.leaf_nodes (does not propagate
+        to its ancestors). The synset's leaves are looked up in the tree's
+        synset index, so no hypernym path is computed.
+
+        If a synset appears in more than one subtree (multiple
+        inheritance), the count is divided equally among its leaves.
+        Synsets missing from the tree are ignored.
+        """
+        positions = self.tree.synset_leaves(synset)
+
+        if positions is not None:
+            leaf_counts[positions] += float(count) / len(positions)
 
     def __getstate__(self):
         return {
@@ -194,6 +182,10 @@ class MleEstimator(Estimator):
     def _probability(self, f, n):
         return float(f) / n
 
+    def probabilities(self, counts):
+        """ Probabilities of an array of frequencies. """
+        return counts / self.n
+
 
 class LaplaceEstimator(Estimator):
     """
@@ -226,6 +218,10 @@ class LaplaceEstimator(Estimator):
     def _probability(self, f, c, n, k, alpha, *args):
         return float(f + c * alpha) / (n + k * alpha)
 
+    def probabilities(self, counts):
+        """ Probabilities of an array of frequencies (of single classes). """
+        return (counts + self.alpha) / (self.n + self.k * self.alpha)
+
 
 def _datafile(name):
     return open(os.path.join(os.path.dirname(__file__), '../data/' + name),
@@ -389,22 +385,411 @@ class Processor(object):
         base_structures = Counter()
 
         for x, count in data:
-            base_structure = ''
+            base_structure = []
             for string, pos, synset in x:
                 tag = self.tagger._get_tag(string, pos, synset, self.tagtype)
                 tags[tag][string] += count
-                base_structure += '({})'.format(tag)
+                base_structure.append(tag)
 
-            base_structures[base_structure] += count
+            base_structures[tuple(base_structure)] += count
 
         # log.info("Process {} has done its share. Time to rest.".format(process_id))
         return (tags, base_structures)
 
 
+class TagTable(object):
+    """ The tags of a grammar, interned. Tags are numbered in order of first
+    appearance, so ids don't change as the grammar grows.
+    """
+
+    def __init__(self):
+        self.tags = []  # tags[id] = tag
+        self.ids = dict()  # ids[tag] = id
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, i):
+        return self.tags[i]
+
+    def intern(self, tag):
+        try:
+            return self.ids[tag]
+        except KeyError:
+            self.ids[tag] = len(self.tags)
+            self.tags.append(tag)
+            return self.ids[tag]
+
+    def lookup(self, tags):
+        """ Returns the tuple of ids of a sequence of tags, or None if any of
+        the tags is unknown.
+        """
+        try:
+            return tuple(self.ids[tag] for tag in tags)
+        except KeyError:
+            return None
+
+
+class GrammarSampler(object):
+    """ Tables for drawing passwords from a grammar. Holds the cumulative
+    distributions of base structures and of the terminals of every tag,
+    which are searched with np.searchsorted, and the tags of every base
+    structure as arrays of tag ids. Built once per grammar (see
+    Grammar.sampler()).
+    """
+
+    def __init__(self, grammar):
+        structs = list(grammar.base_structures.keys())
+        counts = np.array([grammar.base_structures[s] for s in structs], dtype=float)
+        self.base_structs = [grammar.struct_strings[s] for s in structs]
+        self.struct_probs = counts / counts.sum()  # MLE
+        self.struct_cdf = np.cumsum(self.struct_probs)
+
+        self.tags = list(grammar.tag_table.tags)
+
+        self.words = []  # words[i] = terminals of tag i
+        self.probs = []  # probs[i] = probabilities of the terminals of tag i
+        self.cdfs = []
+
+        index = grammar.probability_index()
+        for tag in self.tags:
+            table = index.table(tag)
+            self.words.append(table.words)
+            self.probs.append(table.probs)
+            self.cdfs.append(table.cdf)
+
+        # the tags of all base structures, concatenated
+        self.struct_len = np.array([len(s) for s in structs], dtype=np.intp)
+        self.struct_offset = np.cumsum(self.struct_len) - self.struct_len
+        self.struct_tags = np.array([tag for s in structs for tag in s], dtype=np.intp)
+
+    @staticmethod
+    def _draw(cdf, n, rng):
+        # side='right' skips outcomes with probability 0
+        return np.searchsorted(cdf, rng.random(n) * cdf[-1], side='right')
+
+    def sample(self, n, rng=np.random):
+        """ Draw n passwords.
+
+        Returns:
+            list of tuples (password, base_struct, probability)
+        """
+        draw = self._draw
+
+        structs = draw(self.struct_cdf, n, rng)
+        lengths = self.struct_len[structs]
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        n_slots = int(ends[-1]) if n > 0 else 0
+
+        # the tag of every slot (tag position) of every password
+        slot_tags = self.struct_tags[np.repeat(self.struct_offset[structs] - starts, lengths)
+                                     + np.arange(n_slots)]
+
+        # draw all the terminals of a tag at once
+        terminals = np.empty(n_slots, dtype=object)
+        slot_probs = np.empty(n_slots)
+
+        order = np.argsort(slot_tags, kind='stable')
+        boundaries = np.flatnonzero(np.diff(slot_tags[order])) + 1
+        for slots in np.split(order, boundaries) if n_slots else []:
+            tag = slot_tags[slots[0]]
+            j = draw(self.cdfs[tag], len(slots), rng)
+            terminals[slots] = self.words[tag][j]
+            slot_probs[slots] = self.probs[tag][j]
+
+        probs = self.struct_probs[structs]
+        nonempty = lengths > 0
+        if n_slots:
+            probs[nonempty] *= np.multiply.reduceat(slot_probs, starts[nonempty])
+
+        terminals = terminals.tolist()
+        base_structs = self.base_structs
+
+        return [(''.join(terminals[a:b]), base_structs[i], p)
+                for i, a, b, p in zip(structs.tolist(), starts.tolist(),
+                                      ends.tolist(), probs.tolist())]
+
+
+class TerminalTable(object):
+    """ The terminals of a tag, sorted by decreasing probability, with the
+    arrays of their counts, probabilities and cumulative probabilities.
+    """
+
+    def __init__(self, words, counts, probs):
+        self.words = np.array(words, dtype=object)
+        self.counts = np.asarray(counts)
+        self.probs = np.asarray(probs, dtype=float)
+        self.cdf = np.cumsum(self.probs)
+        self._positions = None
+
+    @classmethod
+    def from_counts(cls, tag_dict, estimator):
+        terminals = tag_dict.most_common()
+        counts = np.array([count for _, count in terminals])
+        return cls([word for word, _ in terminals], counts,
+                   estimator.probabilities(counts.astype(float)))
+
+    def __len__(self):
+        return len(self.words)
+
+    def position(self, word):
+        """ Returns the position of a terminal in the table, or None. """
+        if self._positions is None:
+            self._positions = {w: i for i, w in enumerate(self.words.tolist())}
+        return self._positions.get(word)
+
+
+class ProbabilityIndex(object):
+    """ The probability tables of a grammar (see TerminalTable), computed
+    once per tag and shared by predict(), predict_async(), predict_batch(),
+    the sampler, tag_probabilities() and the writers. Dropped by
+    Grammar._invalidate() when the counts change.
+
+    For predict_batch(), terminals are also numbered across tags: those of a
+    tag get consecutive ids, from an offset assigned when the tag is first
+    looked up. Id 0 stands for any unseen terminal.
+    """
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.tables = dict()  # tables[tag] = TerminalTable
+        self.offsets = dict()  # offsets[tag] = id of the first terminal of tag
+        self._chunks = [np.zeros(1)]  # probabilities of consecutive ids
+        self._size = 1
+        self._logprobs = np.zeros(0)
+
+    def table(self, tag):
+        try:
+            return self.tables[tag]
+        except KeyError:
+            pass
+
+        table = self.grammar._terminal_table(tag)
+        self.tables[tag] = table
+        self.offsets[tag] = self._size
+        self._chunks.append(table.probs)
+        self._size += len(table)
+        return table
+
+    def terminal_id(self, tag, string):
+        i = self.table(tag).position(string)
+        return 0 if i is None else self.offsets[tag] + i
+
+    def prob(self, tag, string):
+        table = self.table(tag)
+        i = table.position(string)
+        return 0 if i is None else float(table.probs[i])
+
+    def struct_prob(self, tags):
+        grammar = self.grammar
+        return grammar.base_structures.get(grammar.tag_table.lookup(tags), 0) / grammar.counter
+
+    def logprobs(self):
+        """ Returns the array of the log-probabilities of all terminal ids. """
+        if len(self._logprobs) != self._size:
+            with np.errstate(divide='ignore'):
+                self._logprobs = np.log(np.concatenate(self._chunks))
+        return self._logprobs
+
+
+class TagAutomaton(object):
+    """ A deterministic automaton that accepts the base structures of a
+    grammar, one tag id at a time. Its states are the prefixes of the base
+    structures (a trie), numbered from 0 (the empty prefix). For every state,
+    accept[state] is the probability of the base structure it spells (0 if
+    none) and best[state] the highest probability of a base structure that
+    starts with it. Built once per grammar (see Grammar.tag_automaton()).
+    """
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self._bounds = None
+        self.parents = [-1]
+        self.labels = [-1]  # labels[state] = id of the last tag of the prefix
+        self.accept = [0]
+        children = [dict()]
+
+        total = sum(grammar.base_structures.values())
+        for struct, count in grammar.base_structures.items():
+            state = 0
+            for tag_id in struct:
+                child = children[state].get(tag_id)
+                if child is None:
+                    child = len(self.parents)
+                    children[state][tag_id] = child
+                    children.append(dict())
+                    self.parents.append(state)
+                    self.labels.append(tag_id)
+                    self.accept.append(0)
+                state = child
+            self.accept[state] = count / total
+
+        # children are numbered after their parents
+        self.best = list(self.accept)
+        for state in range(len(self.parents) - 1, 0, -1):
+            parent = self.parents[state]
+            self.best[parent] = max(self.best[parent], self.best[state])
+
+        # transitions[tag id * number of states + state] = next state
+        n = len(self.parents)
+        self.transitions = {tag_id * n + state: child
+                            for state, edges in enumerate(children)
+                            for tag_id, child in edges.items()}
+
+    def __len__(self):
+        return len(self.parents)
+
+    def upper_bounds(self):
+        """ Returns, for every state, an upper bound of the probability of
+        a password that continues with one or more words from that state:
+        the highest probability of a base structure it can complete to, times
+        the highest terminal probability of each remaining tag.
+        """
+        if self._bounds is None:
+            grammar = self.grammar
+            max_probs = dict()  # max_probs[tag id] = highest probability of a terminal
+            bounds = [0] * len(self.parents)
+
+            # children are numbered after their parents
+            for state in range(len(self.parents) - 1, 0, -1):
+                tag_id = self.labels[state]
+                if tag_id not in max_probs:
+                    max_probs[tag_id] = grammar._max_terminal_prob(grammar.tag_table[tag_id])
+                through = max_probs[tag_id] * max(self.accept[state], bounds[state])
+                parent = self.parents[state]
+                bounds[parent] = max(bounds[parent], through)
+
+            self._bounds = bounds
+        return self._bounds
+
+    def step(self, state, tag_id):
+        """ Returns the state after tag_id, or -1 if no base structure
+        continues that way.
+        """
+        return self.transitions.get(tag_id * len(self.parents) + state, -1)
+
+    def walk(self, struct):
+        """ Returns the state of a sequence of tag ids, or -1. """
+        state = 0
+        for tag_id in struct:
+            state = self.step(state, tag_id)
+            if state < 0:
+                break
+        return state
+
+    def struct(self, state):
+        """ Returns the tuple of tag ids that leads to a state. """
+        struct = []
+        while state > 0:
+            struct.append(self.labels[state])
+            state = self.parents[state]
+        return tuple(reversed(struct))
+
+
+class VocabularyTrie(object):
+    """ A trie of terminals, stored in three flat arrays: node n has the
+    outgoing edges first[n]:first[n+1], sorted by label (a code point), and
+    edge e leads to node e + 1 (nodes are numbered breadth-first, so the
+    children of a node are consecutive); terminal[n] is 1 if the path to n
+    spells a terminal. The arrays can be memoryviews of a grammar file (see
+    storage.Vocabulary.trie()).
+    """
+
+    def __init__(self, first, labels, terminal):
+        self.first = first
+        self.labels = labels
+        self.terminal = terminal
+
+    @classmethod
+    def build(cls, words):
+        words = sorted(words)
+        first = array('i')
+        labels = array('I')
+        terminal = array('B')
+
+        queue = deque([(0, len(words), 0)])  # words[lo:hi] share a prefix of length depth
+        while queue:
+            lo, hi, depth = queue.popleft()
+            is_terminal = lo < hi and len(words[lo]) == depth
+            terminal.append(is_terminal)
+            lo += is_terminal
+            first.append(len(labels))
+
+            while lo < hi:
+                c = ord(words[lo][depth])
+                prefix = words[lo][:depth]
+                end = hi if c == sys.maxunicode else bisect_left(words, prefix + chr(c + 1), lo, hi)
+                labels.append(c)
+                queue.append((lo, end, depth + 1))
+                lo = end
+
+        first.append(len(labels))
+        return cls(first, labels, terminal)
+
+    def prefixes(self, text, start=0, limit=None):
+        """ Yields the ends of the terminals that text[start:] begins with,
+        in increasing order, up to limit characters long.
+        """
+        first, labels, terminal = self.first, self.labels, self.terminal
+        end = len(text) if limit is None else min(len(text), start + limit)
+
+        node = 0
+        for i in range(start, end):
+            c = ord(text[i])
+            lo, hi = first[node], first[node + 1]
+            e = bisect_left(labels, c, lo, hi)
+            if e == hi or labels[e] != c:
+                return
+            node = e + 1
+            if terminal[node]:
+                yield i + 1
+
+
+class Vocabulary(object):
+    """ The terminals of a grammar, each mapped to the tags that produce it
+    and its probability under each, as a list of tuples (tag id, p). Built
+    once per grammar, see Grammar.vocabulary(). storage.Vocabulary reads the
+    same index from a grammar file.
+    """
+
+    def __init__(self, grammar):
+        self.terminals = dict()  # terminals[word] = [(tag id, p), ...]
+        self._trie = None
+
+        index = grammar.probability_index()
+        for tag in list(grammar.tag_dicts.keys()):
+            tag_id = grammar.tag_table.intern(tag)
+            table = index.table(tag)
+            for word, p in zip(table.words.tolist(), table.probs.tolist()):
+                self.terminals.setdefault(word, []).append((tag_id, p))
+
+    def __len__(self):
+        return len(self.terminals)
+
+    def __contains__(self, word):
+        return word in self.terminals
+
+    def __iter__(self):
+        return iter(self.terminals)
+
+    def lookup(self, word):
+        """ Returns the list of tuples (tag id, p) of a terminal. """
+        return self.terminals.get(word, [])
+
+    def trie(self):
+        """ Returns the VocabularyTrie of the terminals, built on first use. """
+        if self._trie is None:
+            self._trie = VocabularyTrie.build(self.terminals)
+        return self._trie
+
+
 class Grammar(object):
 
     def __init__(self, tagtype='backoff', estimator='mle'):
-        self.base_structures = Counter()
+        self.base_structures = Counter()  # base_structures[(tag id, ...)] = count
+        self.struct_strings = dict()  # struct_strings[(tag id, ...)] = '(tag)...'
+        self.tag_table = TagTable()
         self.probabilities = dict()
         self.tag_dicts = defaultdict(Counter)
         # self.verb_treecut = None
@@ -417,18 +802,46 @@ class Grammar(object):
         self.lowres = None
         self.tagtype = tagtype
 
+        # derived from the counts on demand, cleared when they change
+        self._sampler = None
+        self._probability_index = None
+        self._vocabulary = None
+        self._tag_automaton = None
+
+    def _invalidate(self):
+        """ Discard structures derived from the counts. """
+        self._sampler = None
+        self._probability_index = None
+        self._vocabulary = None
+        self._tag_automaton = None
+
+    def _add_base_structure(self, tags, count):
+        """ Adds count to the base structure made of a sequence of tags,
+        returning its tuple of tag ids.
+        """
+        struct = tuple(self.tag_table.intern(tag) for tag in tags)
+        if struct not in self.struct_strings:
+            self.struct_strings[struct] = ''.join('({})'.format(tag) for tag in tags)
+
+        self.base_structures[struct] += count
+        return struct
+
+    def struct_tags(self, struct):
+        """ Returns the tags of a base structure (a tuple of tag ids). """
+        return [self.tag_table[i] for i in struct]
+
     def add_vocabulary(self, vocab):
         tagger = GrammarTagger()
         for string, pos, synset in vocab:
             tag = tagger._get_tag(string, pos, synset, self.tagtype)
             self.tag_dicts[tag][string] = 0
+        self._invalidate()
 
     def get_vocab(self):
-        vocab = set()
-        for tag_dict in self.tag_dicts.values():
-            for word in tag_dict.keys():
-                vocab.add(word)
-        return vocab
+        """ Returns the vocabulary index (see vocabulary()), which supports
+        membership tests and iteration like a set of the terminals.
+        """
+        return self.vocabulary()
 
     def _get_tag_prob_estimator(self, tag):
         samplesize = sum(self.tag_dicts[tag].values())
@@ -440,6 +853,15 @@ class Grammar(object):
 
         return estimator
 
+    def _max_terminal_prob(self, tag):
+        table = self.probability_index().table(tag)  # in decreasing order of probability
+        return float(table.probs[0]) if len(table) else 0
+
+    def _terminal_table(self, tag):
+        if tag not in self.tag_dicts:
+            return TerminalTable([], [], [])
+        return TerminalTable.from_counts(self.tag_dicts[tag], self._get_tag_prob_estimator(tag))
+
     def fit_parallel(self, X, num_workers=4):
         import gc
         gc.collect()
@@ -456,8 +878,8 @@ class Grammar(object):
         i = 0
         for result in pool.imap(Processor(tagger, self.tagtype), x_gen):
             tag_results, base_struct_results = result
-            for base_struct, count in base_struct_results.items():
-                self.base_structures[base_struct] += count
+            for tags, count in base_struct_results.items():
+                self._add_base_structure(tags, count)
                 self.counter += count
             for tag, terminals in tag_results.items():
                 # log.info("tag: %s" % tag)
@@ -466,6 +888,7 @@ class Grammar(object):
             i += 1
             log.info("Processed {}/{} result batches...".format(i, num_parts))
 
+        self._invalidate()
         log.info("Fitting completed.")
 
     def fit(self, X, num_workers=None):
@@ -482,66 +905,73 @@ class Grammar(object):
             x - a list of tuples in the form (string, pos, str(synset))
         """
         log.debug(x)
-        base_structure = ''
+        tags = []
         for string, pos, synset in x:
             tag = self.tagger._get_tag(string, pos, synset, self.tagtype)
             self.tag_dicts[tag][string] += count
-            base_structure += '({})'.format(tag)
-
-        self.base_structures[base_structure] += count
-        log.debug(base_structure)
-
-    def sample(self, N):
-        """ Sample N observations from this probabilistic model.
-
-        Return:
-            list of tuples (password, base_struct, probability)
+            tags.append(tag)
+
+        struct = self._add_base_structure(tags, count)
+        self._invalidate()
+        log.debug(self.struct_strings[struct])
+
+    def sampler(self):
+        """ Returns the sampling tables of this grammar, built on first use. """
+        if self._sampler is None:
+            self._sampler = GrammarSampler(self)
+        return self._sampler
+
+    def tag_automaton(self):
+        """ Returns the TagAutomaton of the base structures, built on first use. """
+        if self._tag_automaton is None:
+            self._tag_automaton = TagAutomaton(self)
+        return self._tag_automaton
+
+    def vocabulary(self):
+        """ Returns the Vocabulary of the grammar. Tags that appear in no
+        base structure are added to the tag table, so that every tag has an id.
         """
-        # Prepare data structures for fast-ish sampling
+        if self._vocabulary is None:
+            self._vocabulary = Vocabulary(self)
+        return self._vocabulary
 
-        base_structs = []
-        base_struct_probs = []
-        tag2words = dict()  # tag2words['jj'] = ['hot', 'cold', ...]
-        tag2probs = dict()  # tag2probs['jj'] = np.array([.1, .005, ...])
+    def probability_index(self):
+        """ Returns the probability lookups of this grammar, filled on use. """
+        if self._probability_index is None:
+            self._probability_index = ProbabilityIndex(self)
+        return self._probability_index
 
-        for k, v in self.base_structures.items():
-            base_structs.append(k)
-            base_struct_probs.append(v)
-        base_struct_probs = np.array(base_struct_probs)
-        base_struct_probs = base_struct_probs / np.sum(base_struct_probs)  # calculate MLE
+    def _tags(self, x):
+        return [self.tagger._get_tag(string, pos, synset, self.tagtype)
+                for string, pos, synset in x]
 
-        for tag, v in self.tag_dicts.items():
-            W = []
-            P = []
-            estimator = self._get_tag_prob_estimator(tag)
-            for word, count in v.items():
-                W.append(word)
-                P.append(estimator.probability(count))
-            tag2words[tag] = W
-            tag2probs[tag] = P
+    def _predict(self, x, index):
+        tags = self._tags(x)
+        p = 1
+        for tag, (string, pos, synset) in zip(tags, x):
+            p *= index.prob(tag, string)
 
-        # Sample
+        return p * index.struct_prob(tags)
 
-        base_struct_sample_indices = np.random.choice(  # sample from base structures
-            len(base_structs), size=N,
-            replace=True, p=base_struct_probs
-        )
+    def sample(self, N, batch_size=100000, rng=np.random):
+        """ Sample N observations from this probabilistic model.
 
-        # outcomes = []                            # final sample outcome:
-        #                                          # list of tuples (string, prob)
+        Passwords are drawn in batches of batch_size, each with a few
+        vectorized searches in cumulative distributions (see GrammarSampler).
 
-        for i in base_struct_sample_indices:  # for each base structure,
-            base_struct = base_structs[i]  # sample a word from each of its tags
-            outcome = ''  # one sampling outcome
-            outcome_prob = base_struct_probs[i]
+        Args:
+            rng - source of random numbers, e.g., a numpy.random.Generator
 
-            for tag in re.findall(r'\(([^()]+)\)', base_struct):
-                pdist = tag2probs[tag]
-                j = np.random.choice(len(pdist), replace=True, p=pdist)
-                outcome += tag2words[tag][j]
-                outcome_prob *= pdist[j]
+        Return:
+            list of tuples (password, base_struct, probability)
+        """
+        sampler = self.sampler()
 
-            yield (outcome, base_struct, outcome_prob)
+        while N > 0:
+            n = min(N, batch_size)
+            for outcome in sampler.sample(n, rng):
+                yield outcome
+            N -= n
 
     def predict(self, X):
         """
@@ -551,40 +981,10 @@ class Grammar(object):
         Args:
             X - a list of lists of tuples in the form (string, pos, str(synset))
         """
-
-        tag_prob_cache = dict()  # tag_prob_cache[tag][word] = p
-
-        def prob(tag, string):
-            if tag not in tag_prob_cache:
-                tag_prob_cache[tag] = dict()
-                samplesize = sum(self.tag_dicts[tag].values())
-                vocabsize = len(self.tag_dicts[tag].keys())
-
-                if self.estimator == 'laplace':
-                    estimator = LaplaceEstimator(samplesize, vocabsize, 1)
-                else:
-                    estimator = MleEstimator(samplesize)
-
-                for k, count in self.tag_dicts[tag].items():
-                    tag_prob_cache[tag][k] = estimator.probability(count)
-
-            try:
-                return tag_prob_cache[tag][string]
-            except KeyError:
-                return 0
+        index = self.probability_index()
 
         for x in X:
-            base_structure = ''
-            p = 1
-            for string, pos, synset in x:
-                tag = self.tagger._get_tag(string, pos, synset, self.tagtype)
-                base_structure += '({})'.format(tag)
-
-                p *= prob(tag, string)
-
-            p *= self.base_structures[base_structure] / self.counter
-
-            yield p
+            yield self._predict(x, index)
 
     def predict_async(self):
         """
@@ -601,41 +1001,119 @@ class Grammar(object):
         Args:
             x - a list of tuples in the form (string, pos, str(synset))
         """
+        index = self.probability_index()
+
+        while True:
+            x = yield
+            yield self._predict(x, index)
+
+    def predict_batch(self, X):
+        """
+        Returns the natural log-probabilities of many strings under this
+        grammar, as a numpy array (-inf where the probability is 0). Unlike
+        the products in predict(), the sums of logs don't underflow for long
+        strings.
 
-        tag_prob_cache = dict()  # tag_prob_cache[tag][word] = p
+        Args:
+            X - a list of lists of tuples in the form (string, pos, str(synset))
+        """
+        index = self.probability_index()
 
-        def prob(tag, string):
-            if tag not in tag_prob_cache:
-                tag_prob_cache[tag] = dict()
-                samplesize = sum(self.tag_dicts[tag].values())
-                vocabsize = len(self.tag_dicts[tag].keys())
+        struct_probs = np.empty(len(X))
+        rows = []  # rows[j] = index in X of the string of terminal j
+        terminals = []
 
-                if self.estimator == 'laplace':
-                    estimator = LaplaceEstimator(samplesize, vocabsize, 1)
-                else:
-                    estimator = MleEstimator(samplesize)
+        for i, x in enumerate(X):
+            tags = self._tags(x)
+            struct_probs[i] = index.struct_prob(tags)
+            for tag, (string, pos, synset) in zip(tags, x):
+                terminals.append(index.terminal_id(tag, string))
+            rows.extend([i] * len(x))
 
-                for k, count in self.tag_dicts[tag].items():
-                    tag_prob_cache[tag][k] = estimator.probability(count)
+        terminal_logprobs = index.logprobs()[np.array(terminals, dtype=np.intp)]
 
-            try:
-                return tag_prob_cache[tag][string]
-            except KeyError:
-                return 0
+        with np.errstate(divide='ignore'):
+            logprobs = np.log(struct_probs)
+        logprobs += np.bincount(np.array(rows, dtype=np.intp),
+                                weights=terminal_logprobs, minlength=len(X))
 
-        while True:
-            x = yield
-            base_structure = ''
-            p = 1
-            for string, pos, synset in x:
-                tag = self.tagger._get_tag(string, pos, synset, self.tagtype)
-                base_structure += '({})'.format(tag)
+        return logprobs
+
+    def prune(self, min_count=None, min_prob=None, max_structures=None,
+              max_terminals=None):
+        """
+        Remove the base structures and terminals below a count or a
+        probability, or beyond a number of the most probable ones. Tags left
+        without terminals are removed with the base structures that use them.
 
-                p *= prob(tag, string)
+        The estimators renormalize what remains: probabilities are derived
+        from the remaining counts (and, with 'laplace', the remaining
+        vocabulary size), and the observations of the removed base
+        structures are subtracted from self.counter.
 
-            p *= self.base_structures[base_structure] / self.counter
+        Args:
+            min_count - remove what was observed fewer times
+            min_prob - remove what has a lower probability (terminals:
+                given their tag)
+            max_structures - keep at most this many base structures
+            max_terminals - keep at most this many terminals per tag
 
-            yield p
+        Returns:
+            a dict with the probability mass removed, before renormalization:
+                'tags' - maps every pruned tag to the mass of its removed terminals
+                'structures' - mass of the removed base structures
+                'total' - probability of the passwords that can no longer be
+                    generated
+        """
+        def pruned(rank, count, p, max_size):
+            return (min_count is not None and count < min_count) or \
+                   (min_prob is not None and p < min_prob) or \
+                   (max_size is not None and rank >= max_size)
+
+        tag_loss = dict()
+
+        index = self.probability_index()
+
+        for tag in list(self.tag_dicts.keys()):
+            tag_dict = self.tag_dicts[tag]
+            table = index.table(tag)
+
+            loss = 0
+            for rank, (word, count, p) in enumerate(zip(table.words.tolist(),
+                                                        table.counts.tolist(),
+                                                        table.probs.tolist())):
+                if pruned(rank, count, p, max_terminals):
+                    del tag_dict[word]
+                    loss += p
+
+            if not tag_dict:
+                del self.tag_dicts[tag]
+                loss = 1
+            if loss > 0:
+                tag_loss[tag] = loss
+
+        total = sum(self.base_structures.values())
+        struct_loss = 0
+        kept = 0  # probability of the passwords that remain
+
+        for rank, (struct, count) in enumerate(self.base_structures.most_common()):
+            p = count / total
+            tags = self.struct_tags(struct)
+
+            if pruned(rank, count, p, max_structures) or \
+                    any(tag not in self.tag_dicts for tag in tags):
+                del self.base_structures[struct]
+                del self.struct_strings[struct]
+                self.counter -= count
+                struct_loss += p
+            else:
+                for tag in tags:
+                    p *= 1 - tag_loss.get(tag, 0)
+                kept += p
+
+        self._invalidate()
+
+        return {'tags': tag_loss, 'structures': struct_loss, 'total': max(0, 1 - kept)}
 
     def base_structure_probabilities(self):
         total = 0
@@ -643,60 +1121,61 @@ class Grammar(object):
         for struct, count in rank:
             total += count
 
-        return [(struct, count / total) for struct, count in rank]
+        return [(self.struct_strings[struct], count / total) for struct, count in rank]
 
     def tag_probabilities(self):
-        tag_dicts = self.tag_dicts
+        index = self.probability_index()
         probabilities = defaultdict(Counter)
 
-        for tag in tag_dicts.keys():
-            samplesize = sum(tag_dicts[tag].values())
-            vocabsize = len(tag_dicts[tag].keys())
-
-            if self.estimator == 'laplace':
-                est = LaplaceEstimator(samplesize, vocabsize, 1)
-            else:
-                est = MleEstimator(samplesize)
-
-            for lemma, freq in tag_dicts[tag].most_common():
-                probabilities[tag][lemma] = est.probability(freq)
+        for tag in self.tag_dicts.keys():
+            table = index.table(tag)
+            probabilities[tag] = Counter(dict(zip(table.words.tolist(), table.probs.tolist())))
 
         return probabilities
 
-    # def __getstate__(self):
-    #     d = dict(self.__dict__)
-    #     # these attributes will be saved in plain text (not pickled)
-    #     d['base_structures'] = Counter()
-    #     d['tag_dicts'] =  defaultdict(Counter)
-    #     return d
-
-    # def __setstate__(self, state):
-    #
-
-    def write_to_disk(self, path):
-        # remove previous grammar
-        try:
-            shutil.rmtree(path)
-        except OSError:  # in case the above folder does not exist
-            pass
-
-        # recreate the folders empty
-        os.makedirs(os.path.join(path, 'nonterminals'))
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        d['_sampler'] = None  # rebuilt on demand
+        d['_probability_index'] = None
+        d['_vocabulary'] = None
+        d['_tag_automaton'] = None
+        return d
 
-        with open(os.path.join(path, 'rules.txt'), 'w+') as f:
-            for struct, p in self.base_structure_probabilities():
-                f.write('{}\t{}\n'.format(struct, p))
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._sampler = None
+        self._probability_index = None
+        self._vocabulary = None
+        self._tag_automaton = None
+
+        if 'tag_table' not in d:
+            # pickled when base structures were keyed by strings '(tag)...'
+            base_structures = self.base_structures
+            self.base_structures = Counter()
+            self.struct_strings = dict()
+            self.tag_table = TagTable()
+            for string, count in base_structures.items():
+                self._add_base_structure(re.findall(r'\(([^()]+)\)', string), count)
+
+    def write_to_disk(self, path, text=True, num_workers=1, pickles=None):
+        """
+        Write this grammar to a folder, replacing it. The folder has:
+            grammar.bin - the grammar (see learning.storage)
+            rules.txt - the base structures and their probabilities
+            nonterminals/*.txt - if text is True, the terminals of every
+                tag and their probabilities (read by guessmaker)
 
-        tags = self.tag_probabilities()
-        for tag in tags.keys():
-            with open(os.path.join(path, 'nonterminals', str(tag) + '.txt'), 'w+') as f:
-                for lemma, p in tags[tag].most_common():
-                    # if str(tag) == "fname":
-                    #     print("{}\t{}\t{}".format(str(tag), lemma, p))
-                    f.write("{}\t{}\n".format(lemma, p))
+        The folder is written under a temporary name and then renamed, so
+        it is never half-written (see storage.write_dir() for what a crash
+        can leave behind).
 
-        self_filepath = os.path.join(path, 'grammar.pickle')
-        pickle.dump(self, open(self_filepath, 'wb'), -1)
+        Args:
+            num_workers - number of processes serializing tags
+            pickles - a dict of file names to objects to pickle into the
+                folder, e.g. the tree cuts
+        """
+        from learning import storage
+        storage.write_dir(self, path, text, num_workers, pickles)
 
     def read(self, path):
         grammar_dir = util.abspath(path)
@@ -704,9 +1183,9 @@ class Grammar(object):
         with open(os.path.join(grammar_dir, 'rules.txt')) as f:
             for line in f:
                 fields = line.split()
-                tags = fields[0]
+                tags = re.findall(r'\(([^()]+)\)', fields[0])
                 # map grammar rule (tags) to probability
-                self.base_structures[tags] = float(fields[1])
+                self._add_base_structure(tags, float(fields[1]))
 
         tagdicts_dir = os.path.join(grammar_dir, 'nonterminals')
 
@@ -724,8 +1203,24 @@ class Grammar(object):
                         sys.stderr.write("error inserting {} in the tag dictionary {}\n"
                                          .format(fields, tag))
 
+        self._invalidate()
+
     @classmethod
-    def from_files(cls, path):
+    def from_files(cls, path, lazy=False):
+        """ Load the grammar written to path by write_to_disk().
+
+        Args:
+            lazy - if True, return a storage.GrammarView of grammar.bin,
+                which reads the terminals of a tag on first access (folders
+                written before grammar.bin existed are loaded entirely)
+        """
+        from learning import storage
+
+        bpath = os.path.join(path, 'grammar.bin')
+        if os.path.exists(bpath):
+            return storage.GrammarView(bpath) if lazy else storage.read(bpath)
+
+        # written before grammar.bin existed
         gpath = os.path.join(path, 'grammar.pickle')
         g = pickle.load(open(gpath, "rb"))
         # g.read(path)
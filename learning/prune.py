@@ -0,0 +1,55 @@
+"""
+Prunes a grammar, removing rare base structures and terminals (see
+Grammar.prune()), and reports the probability mass removed.
+
+Usage:
+    python -m learning.prune grammar_dir output_dir --min_count 2 --max_terminals 100000
+
+"""
+
+import argparse
+import os
+import pickle
+import sys
+
+from learning.model import Grammar
+
+
+def options():
+    parser = argparse.ArgumentParser(description='Remove the base structures '
+                                     'and terminals of a grammar below a count or a probability, or '
+                                     'beyond a number of the most probable ones.')
+    parser.add_argument('grammar_dir')
+    parser.add_argument('output_dir', help='a folder to store the pruned grammar '
+                        '(may be the same as grammar_dir)')
+    parser.add_argument('--min_count', type=float, default=None)
+    parser.add_argument('--min_prob', type=float, default=None)
+    parser.add_argument('--max_structures', type=int, default=None,
+                        help='number of base structures to keep')
+    parser.add_argument('--max_terminals', type=int, default=None,
+                        help='number of terminals to keep per tag')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts = options()
+
+    grammar = Grammar.from_files(opts.grammar_dir)
+
+    # the tree cuts are read before output_dir is emptied
+    treecuts = dict()
+    for name in ('noun_treecut.pickle', 'verb_treecut.pickle'):
+        path = os.path.join(opts.grammar_dir, name)
+        if os.path.exists(path):
+            treecuts[name] = pickle.load(open(path, 'rb'))
+
+    report = grammar.prune(opts.min_count, opts.min_prob,
+                           opts.max_structures, opts.max_terminals)
+
+    grammar.write_to_disk(opts.output_dir, pickles=treecuts)
+
+    for tag, loss in sorted(report['tags'].items(), key=lambda x: x[1], reverse=True):
+        sys.stderr.write("{}\t{}\n".format(tag, loss))
+
+    sys.stderr.write("Removed probability mass: {} (base structures: {})\n"
+                     .format(report['total'], report['structures']))
@@ -0,0 +1,618 @@
+"""
+Single-file binary storage of a grammar, read through a memory map.
+
+Layout of a grammar file (little-endian):
+
+    magic (8 bytes) | version (uint32) | 0 (uint32)
+    index offset (uint64) | index length (uint64)
+    arrays, each aligned to 8 bytes
+    index (JSON)
+
+The index holds the settings of the grammar, the names of its tags and the
+position of every array in the file. Base structures are stored as a rules
+table: the tag ids of all structures, concatenated, with offsets, counts and
+probabilities. For every tag, its terminals are sorted by decreasing
+probability and stored as one UTF-8 blob with an array of offsets, plus the
+arrays of their counts and probabilities. The vocabulary index lists every
+terminal once, sorted by its UTF-8 bytes, with the ids of the tags that
+produce it and the matching probabilities (see Vocabulary), and a trie of
+the terminals (see model.VocabularyTrie).
+
+A GrammarView maps the file and reads the terminals of a tag only when the
+tag is first accessed, so a grammar opens without reading its vocabulary,
+and processes that open the same file share its pages.
+
+write_word_tags() writes a table of the tags of terminals, in the same
+format (word_tags.bin, see guessing.word_tags).
+
+write_dir() writes a grammar folder (see Grammar.write_to_disk()): the
+grammar file, rules.txt and, optionally, the nonterminals/*.txt files. Tags
+are serialized in parallel, and the folder is written under a temporary name
+and then renamed into place (see write_dir()).
+"""
+
+import json
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+
+from collections import Counter
+from collections.abc import MutableMapping
+from multiprocessing import Pool
+
+import numpy as np
+
+from learning.model import Grammar, TerminalTable, VocabularyTrie
+
+MAGIC = b'SGGRAMMR'
+WORD_TAGS_MAGIC = b'SGWRDTAG'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sIIQQ')
+
+
+class StorageError(Exception):
+    pass
+
+
+class _Writer(object):
+
+    def __init__(self, f, magic=MAGIC):
+        self.f = f
+        self.magic = magic
+        self.f.write(b'\0' * _HEADER.size)
+
+    def array(self, a):
+        """ Writes an array, returning its entry in the index. """
+        a = np.ascontiguousarray(a)
+        if a.dtype.byteorder == '>':
+            a = a.astype(a.dtype.newbyteorder('<'))
+        self.align()
+        entry = [self.f.tell(), a.dtype.str, len(a)]
+        self.f.write(a.tobytes())
+        return entry
+
+    def align(self):
+        pad = -self.f.tell() % 8
+        self.f.write(b'\0' * pad)
+
+    def close(self, index):
+        self.align()
+        offset = self.f.tell()
+        data = json.dumps(index).encode('utf-8')
+        self.f.write(data)
+        self.f.seek(0)
+        self.f.write(_HEADER.pack(self.magic, VERSION, 0, offset, len(data)))
+
+
+def _counts(values):
+    """ Counts as an int64 array when they are integers (fitted grammars),
+    float64 otherwise (e.g., grammars read from text files).
+    """
+    a = np.array(values)
+    if a.dtype.kind not in 'iu':
+        a = a.astype(np.float64)
+    return a
+
+
+# set in every worker by _init_worker()
+_grammar = None
+_text_dir = None
+
+
+def _init_worker(grammar, text_dir):
+    global _grammar, _text_dir
+    _grammar = grammar
+    _text_dir = text_dir
+
+
+def _serialize_tag(tag):
+    """ Returns the terminals of a tag as a UTF-8 blob, with the arrays of
+    their offsets in the blob, counts and probabilities, and writes its
+    text file if a text folder was given. Returns None for a tag without a
+    tag dictionary (e.g., pruned).
+    """
+    if tag not in _grammar.tag_dicts:
+        return None
+
+    table = _grammar.probability_index().table(tag)  # in decreasing order of probability
+    words = table.words.tolist()
+
+    if _text_dir is not None:
+        with open(os.path.join(_text_dir, str(tag) + '.txt'), 'w') as f:
+            f.write(''.join(["{}\t{}\n".format(word, p)
+                             for word, p in zip(words, table.probs.tolist())]))
+
+    encoded = [word.encode('utf-8') for word in words]
+    offsets = np.cumsum([0] + [len(w) for w in encoded], dtype=np.int64)
+
+    return b''.join(encoded), offsets, _counts(table.counts.tolist()), table.probs
+
+
+def write(grammar, path, num_workers=1, text_dir=None):
+    """ Write a Grammar to a single file at path.
+
+    Args:
+        num_workers - number of processes serializing tags
+        text_dir - if given, also write a text file per tag in this folder
+    """
+    tag_table = grammar.tag_table
+    tags = list(tag_table.tags) + [tag for tag in grammar.tag_dicts.keys()
+                                   if tag not in tag_table.ids]
+
+    with open(path, 'wb') as f:
+        writer = _Writer(f)
+
+        structs = list(grammar.base_structures.keys())
+        counts = _counts([grammar.base_structures[s] for s in structs])
+        lengths = np.array([len(s) for s in structs], dtype=np.int64)
+
+        rules = {
+            'tags': writer.array(np.array([t for s in structs for t in s], dtype=np.int32)),
+            'offsets': writer.array(np.concatenate(([0], np.cumsum(lengths)))),
+            'counts': writer.array(counts),
+            'probs': writer.array(counts / counts.sum() if len(counts) else counts)
+        }
+
+        if num_workers > 1:
+            pool = Pool(num_workers, initializer=_init_worker, initargs=(grammar, text_dir))
+            serialized = pool.imap(_serialize_tag, tags, chunksize=16)
+        else:
+            pool = None
+            _init_worker(grammar, text_dir)
+            serialized = map(_serialize_tag, tags)
+
+        tag_entries = []
+        postings = dict()  # postings[encoded word] = [(tag id, p), ...]
+        for tag_id, result in enumerate(serialized):
+            if result is None:
+                tag_entries.append(None)
+                continue
+
+            blob, offsets, counts, probs = result
+
+            bounds = offsets.tolist()
+            for a, b, p in zip(bounds[:-1], bounds[1:], probs.tolist()):
+                postings.setdefault(blob[a:b], []).append((tag_id, p))
+
+            writer.align()
+            entry = {'blob': [f.tell(), len(blob)]}
+            f.write(blob)
+
+            entry['offsets'] = writer.array(offsets)
+            entry['counts'] = writer.array(counts)
+            entry['probs'] = writer.array(probs)
+            tag_entries.append(entry)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        vocabulary = _write_vocabulary(writer, postings)
+
+        writer.close({
+            'version': VERSION,
+            'estimator': grammar.estimator,
+            'tagtype': grammar.tagtype,
+            'lowres': grammar.lowres,
+            'counter': grammar.counter,
+            'n_table_tags': len(tag_table),
+            'tags': tags,
+            'rules': rules,
+            'tag_arrays': tag_entries,
+            'vocabulary': vocabulary
+        })
+
+
+def _write_vocabulary(writer, postings):
+    """ Writes the vocabulary index and returns its index entry. """
+    entry = _write_postings(writer, postings)
+
+    trie = VocabularyTrie.build(word.decode('utf-8') for word in sorted(postings))
+    entry['trie'] = {
+        'first': writer.array(np.frombuffer(trie.first, dtype=np.int32)),
+        'labels': writer.array(np.frombuffer(trie.labels, dtype=np.uint32)),
+        'terminal': writer.array(np.frombuffer(trie.terminal, dtype=np.uint8))
+    }
+    return entry
+
+
+def _write_postings(writer, postings):
+    """ Writes encoded words, sorted, each with a list of tuples (tag id, p),
+    and returns their index entry (see _Postings).
+    """
+    words = sorted(postings)
+    lists = [postings[word] for word in words]
+
+    writer.align()
+    entry = {'blob': [writer.f.tell(), sum(len(w) for w in words)]}
+    writer.f.write(b''.join(words))
+
+    entry['offsets'] = writer.array(np.cumsum([0] + [len(w) for w in words], dtype=np.int64))
+    entry['postings'] = writer.array(np.cumsum([0] + [len(l) for l in lists], dtype=np.int64))
+    entry['tags'] = writer.array(np.array([t for l in lists for t, _ in l], dtype=np.int32))
+    entry['probs'] = writer.array(np.array([p for l in lists for _, p in l], dtype=float))
+    return entry
+
+
+def write_dir(grammar, path, text=True, num_workers=1, pickles=None):
+    """ Write a grammar folder, replacing path (see Grammar.write_to_disk()).
+    pickles is a dict of file names to objects pickled into the folder (the
+    tree cuts), so they are swapped in along with the grammar.
+
+    The folder is written to a hidden temporary folder next to path, which
+    is removed if writing fails. The old folder is then renamed aside, the
+    new one renamed to path and the old one removed. Between the two renames
+    there is no folder at path, and a crash between them leaves the grammar
+    in the hidden folders (.<name>.*): the new one, and the old one with the
+    suffix .old. Neither is ever half-written.
+    """
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+
+    tmp = tempfile.mkdtemp(prefix='.' + os.path.basename(path) + '.', dir=parent)
+    try:
+        os.chmod(tmp, 0o755)  # mkdtemp() makes it private
+
+        with open(os.path.join(tmp, 'rules.txt'), 'w') as f:
+            f.write(''.join(['{}\t{}\n'.format(struct, p)
+                             for struct, p in grammar.base_structure_probabilities()]))
+
+        text_dir = None
+        if text:
+            text_dir = os.path.join(tmp, 'nonterminals')
+            os.mkdir(text_dir)
+
+        write(grammar, os.path.join(tmp, 'grammar.bin'), num_workers, text_dir)
+
+        for name, obj in (pickles or {}).items():
+            with open(os.path.join(tmp, name), 'wb') as f:
+                pickle.dump(obj, f, -1)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    # swap the folders; the old one is only removed once the new one is in place
+    old = None
+    if os.path.exists(path):
+        old = tmp + '.old'
+        os.rename(path, old)
+    os.rename(tmp, path)
+    if old is not None:
+        shutil.rmtree(old)
+
+
+def write_word_tags(path, word_tags):
+    """ Write a table of the tags of terminals (see WordTags).
+
+    Args:
+        word_tags - a dict: word -> list of tuples (tag, p)
+    """
+    tags = dict()  # tags[tag] = id in the table
+    postings = {word.encode('utf-8'): [(tags.setdefault(tag, len(tags)), p) for tag, p in pairs]
+                for word, pairs in word_tags.items()}
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        writer = _Writer(f, WORD_TAGS_MAGIC)
+        entry = _write_postings(writer, postings)
+        writer.close({'version': VERSION, 'tags': list(tags), 'words': entry})
+    os.replace(tmp, path)
+
+
+def read(path):
+    """ Read a grammar file into a Grammar (as opposed to a GrammarView). """
+    view = GrammarView(path)
+    grammar = Grammar(tagtype=view.tagtype, estimator=view.estimator)
+
+    grammar.lowres = view.lowres
+    grammar.counter = view.counter
+    grammar.base_structures = view.base_structures
+    grammar.struct_strings = view.struct_strings
+    grammar.tag_table = view.tag_table
+
+    for tag in view.file.tag_ids:
+        words, counts, _ = view.file.terminals(tag)
+        grammar.tag_dicts[tag] = Counter(dict(zip(words, counts.tolist())))
+
+    return grammar
+
+
+class MappedFile(object):
+    """ Read access to a file written by _Writer through a memory map.
+    Arrays are views of the map, they aren't copied.
+    """
+
+    def __init__(self, path, magic=MAGIC, kind='grammar file'):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < _HEADER.size:
+            raise StorageError("{} is not a {}".format(path, kind))
+
+        file_magic, version, _, offset, length = _HEADER.unpack_from(self.map)
+        if file_magic != magic:
+            raise StorageError("{} is not a {}".format(path, kind))
+        if version != VERSION:
+            raise StorageError("{} has version {}, expected {}".format(path, version, VERSION))
+
+        self.index = json.loads(self.map[offset:offset + length].decode('utf-8'))
+
+    def array(self, entry):
+        offset, dtype, size = entry
+        return np.frombuffer(self.map, dtype=np.dtype(dtype), count=size, offset=offset)
+
+    def buffer(self, entry):
+        """ Returns an array as a memoryview of the map, whose items are
+        plain ints (faster than numpy scalars for one item at a time).
+        """
+        offset, dtype, size = entry
+        dtype = np.dtype(dtype)
+        return memoryview(self.map)[offset:offset + size * dtype.itemsize].cast(dtype.char)
+
+
+class GrammarFile(MappedFile):
+    """ Read access to a grammar file. """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.tags = self.index['tags']
+        # tags with terminals (a tag can be in a base structure only)
+        self.tag_ids = {tag: i for i, (tag, entry) in
+                        enumerate(zip(self.tags, self.index['tag_arrays'])) if entry is not None}
+
+    def rules(self):
+        """ Returns the arrays (tags, offsets, counts, probs) of the rules
+        table, where the tag ids of structure i are tags[offsets[i]:offsets[i+1]].
+        """
+        rules = self.index['rules']
+        return tuple(self.array(rules[k]) for k in ('tags', 'offsets', 'counts', 'probs'))
+
+    def probs(self, tag):
+        """ Returns the array of the probabilities of the terminals of a tag. """
+        return self.array(self.index['tag_arrays'][self.tag_ids[tag]]['probs'])
+
+    def terminals(self, tag):
+        """ Returns the terminals of a tag (a list), in decreasing order of
+        probability, and the arrays of their counts and probabilities.
+        """
+        entry = self.index['tag_arrays'][self.tag_ids[tag]]
+        start, length = entry['blob']
+        blob = self.map[start:start + length]
+        offsets = self.array(entry['offsets']).tolist()
+
+        words = [blob[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+        return words, self.array(entry['counts']), self.array(entry['probs'])
+
+
+class _Postings(object):
+    """ Words sorted by their UTF-8 bytes, each with a list of tuples
+    (tag id, p), read through the map of a file. Words are found by binary
+    search.
+    """
+
+    def __init__(self, mapped_file, entry):
+        self.file = mapped_file
+        self.map = mapped_file.map
+        self.start = entry['blob'][0]
+        self.offsets = mapped_file.buffer(entry['offsets'])
+        self.postings = mapped_file.buffer(entry['postings'])
+        self.tags = mapped_file.array(entry['tags'])
+        self.probs = mapped_file.array(entry['probs'])
+
+    def _word(self, i):
+        return self.map[self.start + self.offsets[i]:self.start + self.offsets[i + 1]]
+
+    def find(self, word):
+        """ Returns the position of a terminal in the index, or None. """
+        try:
+            key = word.encode('utf-8')
+        except UnicodeEncodeError:
+            return None
+
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._word(lo) == key:
+            return lo
+        return None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, word):
+        return self.find(word) is not None
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._word(i).decode('utf-8')
+
+    def lookup(self, word):
+        """ Returns the list of tuples (tag id, p) of a terminal. """
+        i = self.find(word)
+        if i is None:
+            return []
+        a, b = self.postings[i], self.postings[i + 1]
+        return list(zip(self.tags[a:b].tolist(), self.probs[a:b].tolist()))
+
+
+class Vocabulary(_Postings):
+    """ The vocabulary index of a grammar file, read through the map: a
+    memory-mapped model.Vocabulary. Tag ids are ids in GrammarFile.tags.
+    """
+
+    def __init__(self, grammar_file):
+        super().__init__(grammar_file, grammar_file.index['vocabulary'])
+        self._trie = None
+
+    def trie(self):
+        """ Returns the VocabularyTrie of the terminals, read from the map
+        (or built, for files written without one).
+        """
+        if self._trie is None:
+            entry = self.file.index['vocabulary'].get('trie')
+            if entry is None:
+                self._trie = VocabularyTrie.build(self)
+            else:
+                self._trie = VocabularyTrie(*(self.file.buffer(entry[k])
+                                              for k in ('first', 'labels', 'terminal')))
+        return self._trie
+
+
+class WordTags(_Postings):
+    """ The tags of the terminals of a grammar and their probabilities,
+    as found by the tagger of the scorer, precomputed by guessing.word_tags
+    (see write_word_tags()). lookup() returns the tag ids of grammar, or -1
+    for tags the grammar doesn't have.
+    """
+
+    def __init__(self, path, grammar):
+        mapped_file = MappedFile(path, WORD_TAGS_MAGIC, 'word tags file')
+        super().__init__(mapped_file, mapped_file.index['words'])
+
+        ids = grammar.tag_table.ids
+        self.tag_ids = [ids.get(tag, -1) for tag in mapped_file.index['tags']]
+
+    def lookup(self, word):
+        tag_ids = self.tag_ids
+        return [(tag_ids[t], p) for t, p in super().lookup(word)]
+
+
+class TagDicts(MutableMapping):
+    """ The tag_dicts of a GrammarView. Behaves as a defaultdict(Counter),
+    but reads the terminals of a tag from the file on first access.
+    """
+
+    def __init__(self, grammar_file):
+        self.file = grammar_file
+        self.loaded = dict()
+        self.removed = set()
+
+    def _stored(self, tag):
+        return tag in self.file.tag_ids and tag not in self.removed
+
+    def __getitem__(self, tag):
+        try:
+            return self.loaded[tag]
+        except KeyError:
+            pass
+
+        tag_dict = Counter()
+        if self._stored(tag):
+            words, counts, _ = self.file.terminals(tag)
+            for word, count in zip(words, counts.tolist()):
+                tag_dict[word] = count
+
+        self.loaded[tag] = tag_dict
+        return tag_dict
+
+    def get(self, tag, default=None):
+        return self[tag] if tag in self else default
+
+    def terminals(self, tag):
+        """ Iterates over the (terminal, count) pairs of a tag. Unlike
+        self[tag], doesn't keep the terminals of a stored tag in memory.
+        """
+        if tag in self.loaded:
+            return iter(self.loaded[tag].items())
+        if not self._stored(tag):
+            return iter(())
+
+        words, counts, _ = self.file.terminals(tag)
+        return zip(words, counts.tolist())
+
+    def __setitem__(self, tag, value):
+        self.loaded[tag] = value
+
+    def __delitem__(self, tag):
+        if tag not in self:
+            raise KeyError(tag)
+        self.loaded.pop(tag, None)
+        self.removed.add(tag)
+
+    def __contains__(self, tag):
+        return tag in self.loaded or self._stored(tag)
+
+    def __iter__(self):
+        for tag in self.loaded:
+            yield tag
+        for tag in self.file.tag_ids:
+            if tag not in self.loaded and tag not in self.removed:
+                yield tag
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class GrammarView(Grammar):
+    """ A Grammar backed by a grammar file (see write()). Base structures
+    are read when the view is opened, the terminals of a tag on first
+    access. A view pickles as the path of its file, so worker processes
+    reopen (and share) the map instead of receiving a copy of the grammar.
+    """
+
+    def __init__(self, path):
+        self.file = GrammarFile(path)
+        index = self.file.index
+
+        super().__init__(tagtype=index['tagtype'], estimator=index['estimator'])
+        self.lowres = index['lowres']
+        self.counter = index['counter']
+        self.tag_dicts = TagDicts(self.file)
+
+        tags = self.file.tags
+        for tag in tags:  # ids of the file, see Vocabulary
+            self.tag_table.intern(tag)
+        self.modified = False
+
+        struct_tags, offsets, counts, _ = self.file.rules()
+        struct_tags = struct_tags.tolist()
+        offsets = offsets.tolist()
+
+        for a, b, count in zip(offsets[:-1], offsets[1:], counts.tolist()):
+            struct = tuple(struct_tags[a:b])
+            self.base_structures[struct] = count
+            self.struct_strings[struct] = ''.join('({})'.format(tags[i]) for i in struct)
+
+    def _terminal_table(self, tag):
+        tag_dicts = self.tag_dicts
+        if tag in tag_dicts.loaded or not tag_dicts._stored(tag):  # may have changed
+            return super()._terminal_table(tag)
+
+        return TerminalTable(*self.file.terminals(tag))
+
+    def _max_terminal_prob(self, tag):
+        tag_dicts = self.tag_dicts
+        if tag in tag_dicts.loaded or not tag_dicts._stored(tag):
+            return super()._max_terminal_prob(tag)
+
+        probs = self.file.probs(tag)  # without reading the terminals
+        return float(probs[0]) if len(probs) else 0
+
+    def _invalidate(self):
+        super()._invalidate()
+        self.modified = True
+
+    def vocabulary(self):
+        """ Returns the vocabulary index of the file, unless the grammar
+        has changed since it was opened (or the file has no index).
+        """
+        if self.modified or 'vocabulary' not in self.file.index:
+            return super().vocabulary()
+        if self._vocabulary is None:
+            self._vocabulary = Vocabulary(self.file)
+        return self._vocabulary
+
+    def __reduce__(self):
+        return (GrammarView, (self.file.path,))
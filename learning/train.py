@@ -5,15 +5,13 @@ import logging
 import itertools
 import multiprocessing
 import argparse
-import pickle
-import os
 
 import wordsegment as ws
 import numpy as np
 
 from collections import Counter
 from functools import reduce
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Manager, Pool
 from multiprocessing.managers import BaseManager
 from importlib import reload
 
@@ -24,8 +22,8 @@ from nltk.corpus.reader.wordnet import WordNetCorpusReader
 
 from learning.pos import BackoffTagger, SpacyTagger, COCATagger
 from learning.tagset_conversion import TagsetConverter
-from learning.tree.wordnet import IndexedWordNetTree
-from learning.model import TreeCutModel, Grammar, GrammarTagger
+from learning.tree.wordnet import WordNetTree, IndexedWordNetTree
+from learning.model import TreeCutModel, Grammar
 
 from pattern.en import pluralize, lexeme
 
@@ -360,49 +358,67 @@ def tally_chunk_tag(path, num_workers):
     return results
 
 
-def increment_synset_count(tree, synset, count=1):
-    """ Given  a  WordNetTree, increases the  count  (frequency)
-    of a  synset (does not propagate to its ancestors). This
-    method is more efficient than WordNetTree.increment_synset()
-    as it uses WordNetTree.hashtable() to avoid searching.
-
-    It's different  from increment_node() in that it  increments
-    the counts of ALL nodes  matching a key. In fact, it divides
-    the count by the number of nodes matching the key.
-    increment_node() resolves  ambiguity using the ancestor path
-    received as argument.
+class LeafCounter(object):
+    """ Accumulates synset counts into a vector of leaf counts aligned with
+    tree.leaf_nodes. The leaves of a synset are looked up in the tree's
+    synset index; if a synset has more than one leaf (multiple inheritance)
+    its count is divided equally among them. Increments are buffered and
+    applied in batches with np.add.at.
     """
-    index = tree.index
-    key = synset.name()
 
-    if key in index:
-        nodes = index[key]
-        count = float(count) / len(nodes)
-        for n in nodes:
-            if n.has_children():
-                n = n.find('s.' + n.key)
-            n.increment_value(count, cumulative=False)
+    def __init__(self, tree, batch_size=100000):
+        self.tree = tree
+        self.batch_size = batch_size
+        self.leaf_counts = np.zeros(len(tree.leaf_nodes))
+        self._positions = []
+        self._counts = []
+
+    def add(self, synset, count=1):
+        positions = self.tree.synset_leaves(synset)
+        if positions is None:
+            return
+
+        self._positions.append(positions)
+        self._counts.append(float(count) / len(positions))
+
+        if len(self._positions) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._positions) == 0:
+            return
+
+        lengths = [len(positions) for positions in self._positions]
+        np.add.at(self.leaf_counts,
+                  np.concatenate(self._positions),
+                  np.repeat(self._counts, lengths))
+
+        self._positions = []
+        self._counts = []
+
+    def counts(self):
+        self.flush()
+        return self.leaf_counts
 
 
 def fit_tree_cut_models(passwords, estimator, specificity, num_workers):
     def do_work(passwords, noun_results, verb_results):
         wn = new_wordnet_instance()
 
-        grammar_tagger = GrammarTagger()
         tag_converter = TagsetConverter()
-        noun_tree = IndexedWordNetTree('n', wordnet=wn)
-        verb_tree = IndexedWordNetTree('v', wordnet=wn)
+        counters = {
+            'n': LeafCounter(WordNetTree('n', wordnet=wn)),
+            'v': LeafCounter(WordNetTree('v', wordnet=wn))
+        }
 
         for chunks, count in passwords:
             for string, pos in chunks:
                 syn = synset(string, pos, wn, tag_converter)
-                if syn and syn.pos() == 'n':
-                    increment_synset_count(noun_tree, syn, count)
-                elif syn and syn.pos() == 'v':
-                    increment_synset_count(verb_tree, syn, count)
+                if syn and syn.pos() in counters:
+                    counters[syn.pos()].add(syn, count)
 
-        noun_results.append(np.array([leaf.value for leaf in noun_tree.leaves()]))
-        verb_results.append(np.array([leaf.value for leaf in verb_tree.leaves()]))
+        noun_results.append(counters['n'].counts())
+        verb_results.append(counters['v'].counts())
 
     manager = Manager()
     noun_results = manager.list()
@@ -422,24 +438,33 @@ def fit_tree_cut_models(passwords, estimator, specificity, num_workers):
     noun_counts = np.sum(noun_results, 0)
     verb_counts = np.sum(verb_results, 0)
 
-    noun_tree = IndexedWordNetTree('n')
-    verb_tree = IndexedWordNetTree('v')
+    # rebuild the trees and search their cuts in parallel, one task per tree
+    tasks = [('n', noun_counts, estimator, specificity),
+             ('v', verb_counts, estimator, None)]
 
-    for i, leaf in enumerate(noun_tree.leaves()):
-        leaf.value = noun_counts[i]
-    for i, leaf in enumerate(verb_tree.leaves()):
-        leaf.value = verb_counts[i]
+    if num_workers > 1:
+        with Pool(min(len(tasks), num_workers)) as pool:
+            tcm_n, tcm_v = pool.starmap(fit_tree_cut_model, tasks)
+    else:
+        tcm_n, tcm_v = [fit_tree_cut_model(*task) for task in tasks]
 
-    noun_tree.updateCounts()
-    verb_tree.updateCounts()
+    return tcm_n, tcm_v
 
-    tcm_n = TreeCutModel('n', estimator=estimator, specificity=specificity)
-    tcm_n.fit_tree(noun_tree)
 
-    tcm_v = TreeCutModel('v', estimator=estimator)
-    tcm_v.fit_tree(verb_tree)
+def fit_tree_cut_model(pos, leaf_counts, estimator, specificity):
+    """ Build the WordNet tree of a part-of-speech, assign leaf counts (in
+    the order of tree.leaf_nodes) to it and fit a TreeCutModel. Meant to run
+    in a worker process, hence the fresh WordNet instance.
+    """
+    tree = IndexedWordNetTree(pos, wordnet=new_wordnet_instance())
 
-    return tcm_n, tcm_v
+    tree.set_leaf_values(leaf_counts)
+    tree.updateCounts()
+
+    tcm = TreeCutModel(pos, estimator=estimator, specificity=specificity)
+    tcm.fit_tree(tree)
+
+    return tcm
 
 
 class MyManager(BaseManager): pass
@@ -529,7 +554,7 @@ def fit_grammar(passwords, tagtype, estimator, tcm_n, tcm_v, num_workers):
 
 
 def train_grammar(password_file, outfolder, tagtype='backoff',
-                  estimator='laplace', specificity=None, num_workers=2):
+                  estimator='laplace', specificity=None, num_workers=2, text=True):
     """Train a semantic password model"""
 
     # Chunking and Part-of-Speech tagging
@@ -558,11 +583,9 @@ def train_grammar(password_file, outfolder, tagtype='backoff',
         grammar = fit_grammar(passwords, tagtype, estimator, tcm_n, tcm_v, num_workers)
 
     log.info("Persisting grammar")
-    grammar.write_to_disk(outfolder)
-    noun_filepath = os.path.join(outfolder, 'noun_treecut.pickle')
-    verb_filepath = os.path.join(outfolder, 'verb_treecut.pickle')
-    pickle.dump(tcm_n, open(noun_filepath, 'wb'), -1)
-    pickle.dump(tcm_v, open(verb_filepath, 'wb'), -1)
+    grammar.write_to_disk(outfolder, text, num_workers,
+                          pickles={'noun_treecut.pickle': tcm_n,
+                                   'verb_treecut.pickle': tcm_v})
 
     log.info("Done.")
 
@@ -584,4 +607,6 @@ def options():
                         choices=['pos_semantic', 'pos', 'backoff', 'word'])
     parser.add_argument('-w', '--num_workers', type=int, default=2,
                         help="number of cores available for parallel work")
+    parser.add_argument('--no_text', action='store_true',
+                        help="don't write the nonterminals/*.txt files (needed by guessmaker)")
     return parser.parse_args()
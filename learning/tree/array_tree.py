@@ -0,0 +1,76 @@
+"""
+Array-based snapshot of a tree, for vectorized computations over many
+count vectors at once.
+
+@author: rafa
+"""
+
+import numpy as np
+
+
+class ArrayTree(object):
+    """ Structure of a tree stored in arrays. Nodes are numbered in
+    depth-first order (parents precede their children) and leaves appear in
+    the same order as in tree.leaves().
+
+    Counts are kept outside the structure, in arrays whose first axis is
+    indexed by node (or by leaf), so the same ArrayTree serves any number
+    of count vectors, e.g., bootstrap replicates stacked along the second
+    axis.
+    """
+
+    def __init__(self, tree):
+        keys = []
+        ids = []
+        parent = []
+        depth = []
+        value = []
+        leaf_count = []
+
+        stack = [(tree.root, -1, 0)]  # -> (node, parent index, depth)
+
+        while len(stack):
+            node, p, d = stack.pop()
+            i = len(keys)
+
+            keys.append(node.key)
+            ids.append(getattr(node, 'id', i))
+            parent.append(p)
+            depth.append(d)
+            value.append(node.value)
+            leaf_count.append(getattr(node, 'leaf_count', 1))
+
+            for child in reversed(node.children()):
+                stack.append((child, i, d + 1))
+
+        self.keys = keys
+        self.ids = np.array(ids)
+        self.parent = np.array(parent, dtype=np.intp)
+        self.depth = np.array(depth, dtype=np.intp)
+        self.value = np.array(value, dtype=float)
+        self.leaf_count = np.array(leaf_count, dtype=float)
+
+        self.is_leaf = np.ones(len(keys), dtype=bool)
+        self.is_leaf[self.parent[1:]] = False
+        self.leaves = np.flatnonzero(self.is_leaf)
+
+        # levels[d] holds the indices of the nodes at depth d
+        self.levels = [np.flatnonzero(self.depth == d)
+                       for d in range(self.depth.max() + 1)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def accumulate(self, leaf_values):
+        """ Given an array of leaf values of shape (# of leaves, ...),
+        returns the values of all nodes, where an internal node holds the
+        sum of the leaves in its subtree.
+        """
+        values = np.zeros((len(self),) + leaf_values.shape[1:])
+        values[self.leaves] = leaf_values
+
+        # bottom-up, a level at a time
+        for level in reversed(self.levels[1:]):
+            np.add.at(values, self.parent[level], values[level])
+
+        return values
@@ -0,0 +1,193 @@
+"""
+Bootstrap analysis of the stability of a tree cut.
+
+The leaf counts of a fitted TreeCutModel are resampled (multinomial
+bootstrap) and a cut is fit to every replicate. The proportion of replicates
+in which a class is selected tells whether it reflects the data or sampling
+noise. Cuts are searched for blocks of replicates at once over an ArrayTree,
+and blocks are spread over a pool of workers.
+
+Usage:
+    python -m learning.tree.cut.bootstrap path/to/grammar -n 500 -w 4
+
+"""
+
+import argparse
+import math
+import os
+import pickle
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from learning.tree.array_tree import ArrayTree
+
+
+def findcuts(tree, values, estimator='mle', weight=None):
+    """ Vectorized version of li_abe.findcut (or wagner.findcut, if a weight
+    is given) that searches the cuts of many count vectors at once.
+
+    Args:
+        tree - an ArrayTree
+        values - array of shape (# of nodes, R) holding R count vectors
+            (see ArrayTree.accumulate())
+        estimator - 'mle' or 'laplace'
+        weight - the weighting factor of wagner (None for li_abe)
+
+    Returns:
+        boolean array of shape (# of nodes, R) marking the cut members
+    """
+    N = values[0]  # sample sizes
+    c = tree.leaf_count[:, np.newaxis]
+
+    if estimator == 'laplace':
+        p = (values + c) / (N + tree.leaf_count[0])
+    else:
+        p = values / N
+
+    # data description length of each node, as if it were in a cut
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ddl = np.where(values > 0, -values * np.log2(p / c), 0.)
+
+    # dl(cut) = a * (len(cut) - 1) + b * ddl(cut), see _li_abe and _wagner
+    a = np.log2(N) / 2
+    b = 1 if weight is None else weight * np.log2(N) / N
+
+    # bottom-up: the best cut of a subtree is either its root alone or the
+    # union of the best cuts of the root's children
+    best_ddl = ddl.copy()
+    best_size = np.ones(values.shape)
+    children_ddl = np.zeros(values.shape)
+    children_size = np.zeros(values.shape)
+    chosen = np.ones(values.shape, dtype=bool)
+
+    for d in range(len(tree.levels) - 1, -1, -1):
+        level = tree.levels[d]
+        internal = level[~tree.is_leaf[level]]
+
+        if len(internal):
+            node_dl = b * ddl[internal]
+            cut_dl = a * (children_size[internal] - 1) + b * children_ddl[internal]
+
+            # using <= instead of < leads to better generalization
+            keep = node_dl <= cut_dl
+            chosen[internal] = keep
+            best_ddl[internal] = np.where(keep, ddl[internal], children_ddl[internal])
+            best_size[internal] = np.where(keep, 1, children_size[internal])
+
+        if d > 0:
+            np.add.at(children_ddl, tree.parent[level], best_ddl[level])
+            np.add.at(children_size, tree.parent[level], best_size[level])
+
+    # top-down: a chosen node is in the cut unless an ancestor was chosen
+    covered = np.zeros(values.shape, dtype=bool)
+    for level in tree.levels[1:]:
+        parents = tree.parent[level]
+        covered[level] = covered[parents] | chosen[parents]
+
+    return chosen & ~covered
+
+
+class Replicator(object):
+    """ Fits the cuts of a block of bootstrap replicates and counts, for
+    every class, the replicates in which it was selected.
+    """
+
+    def __init__(self, tree, estimator, weight):
+        self.tree = tree
+        self.estimator = estimator
+        self.weight = weight
+
+        leaf_values = tree.value[tree.leaves]
+        self.sample_size = int(round(leaf_values.sum()))
+        self.p = leaf_values / leaf_values.sum()
+
+        # class (key) of every node
+        self.classes, self.node_class = np.unique(tree.keys, return_inverse=True)
+
+    def __call__(self, block):
+        seed, size = block
+        tree = self.tree
+        rng = np.random.default_rng(seed)
+
+        counts = rng.multinomial(self.sample_size, self.p, size=size)
+        values = tree.accumulate(counts.T.astype(float))
+        cut = findcuts(tree, values, self.estimator, self.weight)
+
+        # a class with duplicated nodes counts once per replicate
+        selected = np.zeros((len(self.classes), size), dtype=int)
+        np.add.at(selected, self.node_class, cut)
+
+        return (selected > 0).sum(1)
+
+
+def bootstrap(tcm, n_replicates=100, num_workers=1, seed=None, block_size=25):
+    """ Bootstrap the cut of a fitted TreeCutModel.
+
+    Args:
+        tcm - a fitted TreeCutModel, whose tree holds the leaf counts
+        n_replicates - number of bootstrap replicates
+        num_workers - number of processes
+        seed - for reproducibility; results don't depend on num_workers
+        block_size - number of replicates fit at once by a worker
+
+    Returns:
+        list of tuples (class, selection frequency, in the original cut),
+        in decreasing order of frequency
+    """
+    # zero-count leaves remain so in every replicate, so the search only
+    # needs the observed part of the tree
+    tree = ArrayTree(tcm.tree.collapsed())
+
+    replicator = Replicator(tree, tcm.estimator, tcm.specificity or None)
+
+    n_blocks = math.ceil(n_replicates / block_size)
+    seeds = np.random.SeedSequence(seed).spawn(n_blocks)
+    sizes = [block_size] * (n_blocks - 1) + [n_replicates - block_size * (n_blocks - 1)]
+    blocks = list(zip(seeds, sizes))
+
+    selected = np.zeros(len(replicator.classes), dtype=int)
+
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            for result in pool.imap_unordered(replicator, blocks):
+                selected += result
+    else:
+        for result in map(replicator, blocks):
+            selected += result
+
+    frequency = selected / n_replicates
+    cut = set(node.key for node in tcm.treecut)
+
+    results = [(str(key), float(f), key in cut)
+               for key, f in zip(replicator.classes, frequency) if f > 0 or key in cut]
+    results.sort(key=lambda x: x[1], reverse=True)
+
+    return results
+
+
+def options():
+    parser = argparse.ArgumentParser(description='Estimate how often each '
+                                     'class of a tree cut is selected in bootstrap replicates of the '
+                                     'training counts.')
+    parser.add_argument('grammar_dir')
+    parser.add_argument('--pos', default='n', choices=['n', 'v'],
+                        help='the tree cut model to analyse: nouns or verbs')
+    parser.add_argument('-n', '--replicates', type=int, default=100,
+                        help='number of bootstrap replicates')
+    parser.add_argument('-w', '--num_workers', type=int, default=2,
+                        help='number of cores available for parallel work')
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts = options()
+
+    name = 'noun_treecut.pickle' if opts.pos == 'n' else 'verb_treecut.pickle'
+    tcm = pickle.load(open(os.path.join(opts.grammar_dir, name), 'rb'))
+
+    for key, frequency, in_cut in bootstrap(tcm, opts.replicates,
+                                            opts.num_workers, opts.seed):
+        print("{}\t{:.3f}\t{}".format(key, frequency, int(in_cut)))
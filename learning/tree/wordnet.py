@@ -9,6 +9,8 @@ from nltk.corpus import wordnet as wn
 from learning.tree.default_tree import DefaultTree, DefaultTreeNode, DepthFirstIterator
 from collections import deque
 
+import numpy as np
+
 class WordNetTreeNode(DefaultTreeNode):
 
     # a counter for ids. Everytime a node is created, next_id is assigned to it
@@ -131,6 +133,12 @@ class WordNetTree(DefaultTree):
         self.pos = pos
         self.wn = wn if wordnet is None else wordnet
 
+        # synset_index['dog.n.01'] = positions (in leaf_nodes) of the leaves
+        # that represent the sense dog.n.01. There is one such leaf per
+        # hypernym path, so the number of paths is the length of the array.
+        self.synset_index = dict()
+        self.leaf_nodes = []
+
         if init:
             self.load(pos)
 
@@ -165,9 +173,91 @@ class WordNetTree(DefaultTree):
                     self.__extend(keys,
                         is_internal = len(path[-1].hyponyms()) > 0)
 
+        self.index_synsets()
+
+    def index_synsets(self):
+        """ Builds leaf_nodes (the leaves in the order of leaves()) and
+        synset_index, which maps a synset name to the positions of its leaves
+        in leaf_nodes. Must be called again if the structure changes.
+        """
+        self.leaf_nodes = self.leaves()
+
+        index = dict()
+        for i, leaf in enumerate(self.leaf_nodes):
+            key = leaf.key
+            # the sense of an internal node is its first child, named s.{key}
+            if leaf.parent is not None and key == 's.' + leaf.parent.key:
+                key = leaf.parent.key
+            if key in index:
+                index[key].append(i)
+            else:
+                index[key] = [i]
+
+        self.synset_index = {key: np.array(positions, dtype=np.intp)
+                             for key, positions in index.items()}
+
+    def synset_leaves(self, synset):
+        """ Returns the positions (in leaf_nodes) of the leaves representing
+        a synset (or synset name), or None if the synset isn't in the tree.
+        """
+        key = synset if isinstance(synset, str) else synset.name()
+        return self.synset_index.get(key)
+
+    def set_leaf_values(self, values):
+        """ Assigns an array of values (in the order of leaf_nodes) to the
+        leaves. Call updateCounts() afterwards to update internal nodes.
+        """
+        for leaf, value in zip(self.leaf_nodes, np.asarray(values).tolist()):
+            leaf.value = value
+
     def updateCounts(self):
         self.root.updateCounts()
 
+    def collapsed(self):
+        """ Returns a copy of this tree in which every subtree with a zero
+        count is collapsed into a single summary leaf. A summary node keeps
+        the key, id, value and leaf_count of the subtree's root, so
+        estimators that depend on leaf_count (e.g., Laplace) see the same
+        numbers. Every node of the copy refers to the node it was copied
+        from through the attribute `origin`.
+
+        The copy only spans the observed part of the hierarchy, which is
+        usually a small fraction of WordNet. Requires updated counts (see
+        updateCounts()).
+        """
+        def copy(node, parent):
+            newnode = WordNetTreeNode(node.key, parent, node.value)
+            newnode.id = node.id
+            newnode.leaf_count = node.leaf_count
+            newnode.origin = node
+            return newnode
+
+        root = copy(self.root, None)
+        stack = [(self.root, root)]
+
+        while len(stack):
+            node, newnode = stack.pop()
+            if node.value == 0:  # leave it as a summary leaf
+                continue
+
+            last = None
+            c = node.leftchild
+            while c is not None:
+                newchild = copy(c, newnode)
+                if last is None:
+                    newnode.leftchild = newchild
+                else:
+                    last.rightsibling = newchild
+                last = newchild
+
+                if c.leftchild is not None:
+                    stack.append((c, newchild))
+                c = c.rightsibling
+
+        tree = WordNetTree(self.pos, self.wn, init=False)
+        tree.root = root
+        return tree
+
     def __extend(self, path, is_internal=False):
         """ Given a path representing a subtree,
         create and insert nodes that are missing.
@@ -235,6 +325,15 @@ class WordNetTree(DefaultTree):
 
 
     def increment_synset(self, synset, freq=1, cumulative=True):
+        positions = self.synset_leaves(synset)
+
+        if positions is not None:
+            freq = float(freq) / len(positions)
+            for i in positions:
+                self.leaf_nodes[i].increment_value(freq, cumulative)
+            return
+
+        # the synset isn't in the tree, insert all its paths
         paths = synset.hypernym_paths()
 
         if len(paths) > 1:
@@ -247,6 +346,8 @@ class WordNetTree(DefaultTree):
                 path.append('s.' + path[-1])
             self.insert(path, freq, cumulative)
 
+        self.index_synsets()
+
     def __getstate__(self):
         nodes = dict()
 
@@ -260,7 +361,8 @@ class WordNetTree(DefaultTree):
         return {
             'root': self.root.id,
             'pos':  self.pos,
-            'nodes': nodes
+            'nodes': nodes,
+            'synset_index': self.synset_index
         }
 
     def __setstate__(self, d):
@@ -298,6 +400,13 @@ class WordNetTree(DefaultTree):
 
         self.root = root_node
         self.pos  = d['pos']
+        self.wn   = wn
+
+        if 'synset_index' in d:
+            self.synset_index = d['synset_index']
+            self.leaf_nodes = self.leaves()
+        else:  # snapshot saved before the index existed
+            self.index_synsets()
 
 
 class IndexedWordNetTree(WordNetTree):
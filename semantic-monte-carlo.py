@@ -22,8 +22,10 @@ def generate_grammar(password_file, output_folder):
     pass
 
 
-def exec_sample(grammar_dir, sample_file, sample_size=10000):
-    cmd = "python -m guessing.sample %d %s > %s" % (sample_size, grammar_dir, sample_file)
+def exec_sample(grammar_dir, sample_file, sample_size=10000, num_workers=1, seed=None):
+    cmd = "python -m guessing.sample %d %s -o %s -w %d" % (sample_size, grammar_dir, sample_file, num_workers)
+    if seed is not None:
+        cmd += " --seed %d" % seed
     result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
     result.communicate()
 
@@ -128,6 +130,9 @@ if __name__ == "__main__":
     parser.add_argument("--test-file", "-t", type=str)
     parser.add_argument("--grammar-dir", "-d", type=str)
     parser.add_argument("--use-trained-grammar", "-s", action="store_true")
+    parser.add_argument("--sample-size", "-n", type=int, default=100000)
+    parser.add_argument("--num-workers", "-w", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
     args = parser.parse_args()
     print(args.grammar_dir)
     _path_to_grammar = args.grammar_dir
@@ -141,7 +146,8 @@ if __name__ == "__main__":
         generate_grammar(args.pwd_file, _path_to_grammar)
         logging.info("Generating grammar done")
     logging.info("Generating samples...")
-    exec_sample(_path_to_grammar, _sample_file, sample_size=100000)
+    exec_sample(_path_to_grammar, _sample_file, sample_size=args.sample_size,
+                num_workers=args.num_workers, seed=args.seed)
     logging.info("Generating samples done")
     logging.info("Scoring test set...")
     exec_score(_path_to_grammar, args.test_file, _scored_test_file)
@@ -18,4 +18,5 @@ if __name__ == '__main__':
                         opts.tagtype,
                         opts.estimator,
                         opts.abstraction,
-                        opts.num_workers)
+                        opts.num_workers,
+                        not opts.no_text)
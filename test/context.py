@@ -4,7 +4,8 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from learning import pos, model, train
-from learning.tree.cut import _li_abe, li_abe
+from learning.tree.cut import _li_abe, li_abe, wagner, bootstrap
+from learning.tree.array_tree import ArrayTree
 from learning.tree.wordnet import WordNetTreeNode, WordNetTree
 from learning.tree.default_tree import DefaultTree, DepthFirstIterator
 from learning.model import MleEstimator, LaplaceEstimator, Grammar
@@ -0,0 +1,18 @@
+from guessing.score import Scorer
+from learning import storage
+from learning.model import Grammar
+
+
+def toy_scorer(tmp_path, passwords, word_tags):
+    """ Returns a Scorer of a grammar trained on passwords (lists of tuples
+    (word, POS tag, synset) with their counts), which takes the tags of its
+    words from word_tags (see storage.write_word_tags()), stored in tmp_path.
+    """
+    grammar = Grammar()
+    for x, count in passwords:
+        grammar.fit_incremental(x, count)
+    grammar.counter = sum(grammar.base_structures.values())
+
+    path = str(tmp_path / 'word_tags.bin')
+    storage.write_word_tags(path, word_tags)
+    return Scorer(grammar, None, None, word_tags=storage.WordTags(path, grammar))
@@ -0,0 +1,39 @@
+import sqlite3
+
+from guessing.cache import ScoreCache, fingerprint
+
+
+def test_score_cache(tmp_path):
+    path = str(tmp_path / 'cache.db')
+
+    cache = ScoreCache(path, 'grammar1')
+    assert cache._db is None  # opened on first use, never before a fork
+    assert cache.get('love123') is None
+    cache.put(('love123', '(vv0)(number3)', ['', 'love', '123'], 0.48))
+    cache.put(('zzz', None, None, 0))
+    cache.close()
+
+    cache = ScoreCache(path, 'grammar1')
+    assert cache.get('love123') == ('love123', '(vv0)(number3)', ['', 'love', '123'], 0.48)
+    assert cache.get('zzz') == ('zzz', None, None, 0)
+    assert cache.stats() == {'hits': 2, 'misses': 0}
+
+    # scores are per grammar
+    assert ScoreCache(path, 'grammar2').get('love123') is None
+
+    cache = ScoreCache(path, 'grammar2', max_size=2)
+    for password in ('a', 'b', 'c'):
+        cache.put((password, None, None, 0))
+    cache.close()
+
+    assert sqlite3.connect(path).execute('SELECT count(*) FROM scores').fetchone()[0] == 2
+    assert ScoreCache(path, 'grammar1').get('love123') is None  # the oldest
+    assert ScoreCache(path, 'grammar2').get('c') == ('c', None, None, 0)
+
+
+def test_fingerprint(tmp_path):
+    (tmp_path / 'grammar.bin').write_bytes(b'grammar')
+    before = fingerprint(str(tmp_path))
+
+    (tmp_path / 'word_tags.bin').write_bytes(b'tags')
+    assert fingerprint(str(tmp_path)) != before
@@ -12,7 +12,7 @@ def test_tagging():
 
     chunk = ('trampolining', 'v', None)
     assert g.tag_semantic_backoff_pos(*chunk) == 'v'
-    assert g._tag_pos_semantic(*chunk) == 'v_unkwn'
+    assert g._tag_pos_semantic(*chunk) == 'v_unk'
     assert g._tag_pos(*chunk) == 'v'
 
     chunk = ('usa', 'np', 'country.n.01')
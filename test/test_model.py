@@ -0,0 +1,296 @@
+import os
+import pickle
+from collections import Counter
+
+import numpy as np
+
+from learning.model import Grammar
+
+
+def toy_grammar(estimator='mle'):
+    grammar = Grammar(estimator=estimator)
+    passwords = [
+        ([('love', 'vv0', None), ('123', None, None)], 10),
+        ([('hate', 'vv0', None), ('123', None, None)], 2),
+        ([('love', 'vv0', None), ('1', None, None)], 4),
+        ([('dogs', 'nn2', 'dog.n.01')], 5),
+        ([('cats', 'nn2', 'cat.n.01'), ('!', None, None)], 1),
+        ([('123', None, None)], 3)
+    ]
+    for x, count in passwords:
+        grammar.fit_incremental(x, count)
+    grammar.counter = sum(grammar.base_structures.values())
+    return grammar
+
+
+def test_sample():
+    grammar = toy_grammar('laplace')
+    struct_probs = dict(grammar.base_structure_probabilities())
+    tag_probs = grammar.tag_probabilities()
+
+    sample = list(grammar.sample(10000, batch_size=3000,
+                                 rng=np.random.default_rng(0)))
+    assert len(sample) == 10000
+
+    for password, base_struct, p in sample:
+        if base_struct == '(vv0)(number3)':
+            expected = struct_probs[base_struct] * \
+                tag_probs['vv0'][password[:4]] * tag_probs['number3'][password[4:]]
+            assert abs(p - expected) < 1e-12
+
+    # the sample follows the distribution of base structures
+    freq = sum(1 for _, s, _ in sample if s == '(dog.n.01)') / len(sample)
+    assert abs(freq - struct_probs['(dog.n.01)']) < 0.02
+
+
+def test_predict_batch():
+    grammar = toy_grammar('laplace')
+    X = [[('love', 'vv0', None), ('123', None, None)],
+         [('dogs', 'nn2', 'dog.n.01')],
+         [('kiss', 'vv0', None), ('1', None, None)],  # unseen terminal
+         [('123', None, None), ('love', 'vv0', None)]]  # unseen structure
+
+    probs = list(grammar.predict(X))
+    logprobs = grammar.predict_batch(X)
+
+    assert len(logprobs) == len(X)
+    assert abs(logprobs[0] - np.log(probs[0])) < 1e-12
+    assert abs(logprobs[1] - np.log(probs[1])) < 1e-12
+    assert logprobs[2] == -np.inf and logprobs[3] == -np.inf
+
+    predict = grammar.predict_async()
+    predict.send(None)
+    assert predict.send(X[0]) == probs[0]
+
+
+def test_base_structures():
+    grammar = toy_grammar()
+    struct = grammar.tag_table.lookup(['vv0', 'number3'])
+
+    assert grammar.base_structures[struct] == 12  # love123 and hate123
+    assert grammar.struct_strings[struct] == '(vv0)(number3)'
+    assert grammar.struct_tags(struct) == ['vv0', 'number3']
+    assert grammar.tag_table.lookup(['vv0', 'unseen']) is None
+
+    # grammars pickled with string keys are migrated
+    state = dict(grammar.__dict__)
+    state['base_structures'] = Counter({grammar.struct_strings[s]: count
+                                        for s, count in grammar.base_structures.items()})
+    del state['tag_table'], state['struct_strings']
+
+    old = Grammar.__new__(Grammar)
+    old.__setstate__(state)
+    assert old.base_structure_probabilities() == grammar.base_structure_probabilities()
+
+
+def test_tag_automaton():
+    grammar = toy_grammar()
+    automaton = grammar.tag_automaton()
+    ids = grammar.tag_table.ids
+
+    vv0 = automaton.step(0, ids['vv0'])
+    assert automaton.accept[vv0] == 0
+    assert automaton.best[vv0] == 12 / 25
+    assert automaton.best[0] == 12 / 25
+
+    state = automaton.step(vv0, ids['number1'])
+    assert automaton.accept[state] == 4 / 25
+    assert automaton.struct(state) == grammar.tag_table.lookup(['vv0', 'number1'])
+    assert automaton.step(state, ids['number1']) == -1
+    assert automaton.step(0, ids['special1']) == -1
+
+    assert len(automaton) == 8  # 7 prefixes of base structures and the empty one
+    for struct, count in grammar.base_structures.items():
+        assert automaton.accept[automaton.walk(struct)] == count / 25
+
+    # (vv0)(number3) with 'love' (14/16) and '123' (1)
+    bounds = automaton.upper_bounds()
+    assert abs(bounds[0] - 14 / 16 * 12 / 25) < 1e-12
+    assert bounds[vv0] == 12 / 25
+    assert bounds[state] == 0
+
+
+def test_storage(tmp_path):
+    from learning import storage
+
+    grammar = toy_grammar('laplace')
+    path = str(tmp_path / 'grammar.bin')
+    storage.write(grammar, path)
+
+    view = storage.GrammarView(path)
+    assert len(view.tag_dicts.loaded) == 0
+
+    X = [[('love', 'vv0', None), ('123', None, None)], [('dogs', 'nn2', 'dog.n.01')]]
+    assert np.array_equal(view.predict_batch(X), grammar.predict_batch(X))
+    # probabilities are read from the file, without loading the tags
+    assert len(view.tag_dicts.loaded) == 0
+    assert set(view.probability_index().tables) == {'vv0', 'number3', 'dog.n.01'}
+
+    assert view.base_structure_probabilities() == grammar.base_structure_probabilities()
+    assert view.tag_probabilities() == grammar.tag_probabilities()
+
+    words, counts, probs = view.file.terminals('number3')
+    assert words == ['123'] and counts.tolist() == [15]
+
+
+def test_vocabulary(tmp_path):
+    from learning import storage
+
+    grammar = toy_grammar()
+    grammar.tag_dicts['love.n.01']['love'] = 1  # a tag without base structures
+    grammar._invalidate()
+
+    vocab = grammar.vocabulary()
+    assert set(vocab) == {'love', 'hate', '123', '1', 'dogs', 'cats', '!'}
+    assert 'cats' in vocab and 'cat' not in vocab
+
+    def tags(vocab, table, word):
+        return sorted((table[i], p) for i, p in vocab.lookup(word))
+
+    assert tags(vocab, grammar.tag_table, 'love') == [('love.n.01', 1.0), ('vv0', 14 / 16)]
+
+    path = str(tmp_path / 'grammar.bin')
+    storage.write(grammar, path)
+    view = storage.GrammarView(path)
+    stored = view.vocabulary()
+
+    assert isinstance(stored, storage.Vocabulary)
+    assert list(stored) == sorted(vocab, key=lambda w: w.encode('utf-8'))
+    for word in vocab:
+        assert tags(stored, view.file.tags, word) == tags(vocab, grammar.tag_table, word)
+    assert 'cat' not in stored and stored.lookup('cat') == []
+    assert len(view.tag_dicts.loaded) == 0
+
+    # a changed view builds its vocabulary from the counts
+    view.tag_dicts['love.n.01']['amor'] = 1
+    view._invalidate()
+    assert 'amor' in view.vocabulary()
+
+
+def test_vocabulary_trie(tmp_path):
+    from learning import storage
+    from learning.model import VocabularyTrie
+
+    trie = VocabularyTrie.build(['i', 'love', 'lovely', 'lo', 'you', 'é'])
+    assert list(trie.prefixes('iloveyou', 1)) == [3, 5]
+    assert list(trie.prefixes('lovelyé', 0, limit=5)) == [2, 4]
+    assert list(trie.prefixes('lovelyé', 6)) == [7]
+    assert list(trie.prefixes('xlove')) == []
+
+    grammar = toy_grammar()
+    path = str(tmp_path / 'grammar.bin')
+    storage.write(grammar, path)
+    stored = storage.GrammarView(path).vocabulary().trie()
+
+    for text in ('love123', 'hate1!', 'dogscats', '12'):
+        for i in range(len(text)):
+            expected = list(grammar.vocabulary().trie().prefixes(text, i))
+            assert list(stored.prefixes(text, i)) == expected
+            assert expected == [j for j in range(i + 1, len(text) + 1)
+                                if text[i:j] in grammar.vocabulary()]
+
+
+def test_word_tags(tmp_path):
+    from learning import storage
+
+    grammar = toy_grammar()
+    path = str(tmp_path / 'word_tags.bin')
+    storage.write_word_tags(path, {'love': [('vv0', 0.875), ('love.n.01', 0.5)],
+                                   'dogs': [('dog.n.01', 1.0)],
+                                   'xyz': []})
+
+    table = storage.WordTags(path, grammar)
+    ids = grammar.tag_table.ids
+    assert len(table) == 3 and sorted(table) == ['dogs', 'love', 'xyz']
+    assert table.lookup('love') == [(ids['vv0'], 0.875), (-1, 0.5)]  # not a tag of grammar
+    assert table.lookup('dogs') == [(ids['dog.n.01'], 1.0)]
+    assert table.lookup('xyz') == [] and table.lookup('cats') == []
+
+
+def test_prune():
+    for estimator in ('mle', 'laplace'):
+        grammar = toy_grammar(estimator)
+        p_hate = grammar.tag_probabilities()['vv0']['hate']
+
+        # removes 'hate' (2), 'cats' (1) and '!' (1), hence (cat.n.01)(special1)
+        report = grammar.prune(min_count=3)
+
+        assert set(grammar.tag_dicts['vv0']) == {'love'}
+        assert 'cat.n.01' not in grammar.tag_dicts
+        assert len(grammar.base_structures) == 4
+        assert grammar.counter == 24
+
+        assert report['tags'] == {'vv0': p_hate, 'cat.n.01': 1, 'special1': 1}
+        assert abs(report['structures'] - 1 / 25) < 1e-12
+        assert abs(report['total'] - (1 / 25 + 16 / 25 * p_hate)) < 1e-12
+
+        for tag, probs in grammar.tag_probabilities().items():
+            assert abs(sum(probs.values()) - 1) < 1e-12
+
+
+def test_merge():
+    from learning.merge import merge
+
+    grammar = toy_grammar()
+    other = Grammar()
+    other.fit_incremental([('dogs', 'nn2', 'dog.n.01')], 25)
+
+    merged = merge([grammar, other])
+    assert merged.counter == 50
+    assert merged.tag_dicts['dog.n.01']['dogs'] == 30
+
+    mixture = merge([grammar, other], weights=[0.8, 0.2])
+    probs = dict(mixture.base_structure_probabilities())
+    assert abs(probs['(dog.n.01)'] - (0.8 * 5 / 25 + 0.2)) < 1e-12
+    assert abs(probs['(vv0)(number3)'] - 0.8 * 12 / 25) < 1e-12
+
+
+def test_merge_max_mapped():
+    from learning.merge import merge
+
+    grammar = Grammar()
+    grammar.fit_incremental([('dogs', 'nn2', 'dog.n.01'), ('cats', 'nn2', 'cat.n.01')], 10)
+
+    # every class maps to three classes, so the structure maps to 9
+    mapper = lambda tag: [(tag + '.a', 0.5), (tag + '.b', 0.3), (tag + '.c', 0.2)]
+
+    merged = merge([grammar], mapper=mapper, max_mapped=None)
+    assert len(merged.base_structures) == 9
+
+    merged = merge([grammar], mapper=mapper, max_mapped=3)
+    probs = dict(merged.base_structure_probabilities())
+    assert len(probs) == 3 and abs(merged.counter - 10) < 1e-9
+    assert abs(probs['(dog.n.01.a)(cat.n.01.a)'] - 0.25 / 0.55) < 1e-12
+    assert abs(probs['(dog.n.01.a)(cat.n.01.b)'] - 0.15 / 0.55) < 1e-12
+    assert abs(probs['(dog.n.01.b)(cat.n.01.a)'] - 0.15 / 0.55) < 1e-12
+
+
+def test_write_to_disk(tmp_path, monkeypatch):
+    from learning import storage
+
+    grammar = toy_grammar('laplace')
+    path = str(tmp_path / 'grammar')
+
+    grammar.write_to_disk(path, num_workers=2, pickles={'noun_treecut.pickle': {'dog': 1}})
+    with open(os.path.join(path, 'noun_treecut.pickle'), 'rb') as f:
+        assert pickle.load(f) == {'dog': 1}
+    with open(os.path.join(path, 'nonterminals', 'vv0.txt')) as f:
+        assert f.read() == 'love\t{}\nhate\t{}\n'.format(15 / 18, 3 / 18)
+
+    loaded = Grammar.from_files(path)
+    assert loaded.base_structure_probabilities() == grammar.base_structure_probabilities()
+    assert loaded.tag_probabilities() == grammar.tag_probabilities()
+
+    # a failed write leaves the previous grammar in place
+    def fail(*args):
+        raise IOError()
+    monkeypatch.setattr(storage, 'write', fail)
+    try:
+        grammar.write_to_disk(path, text=False, pickles={'noun_treecut.pickle': None})
+    except IOError:
+        pass
+
+    assert os.listdir(str(tmp_path)) == ['grammar']
+    assert os.path.exists(os.path.join(path, 'nonterminals', 'vv0.txt'))
+    with open(os.path.join(path, 'noun_treecut.pickle'), 'rb') as f:
+        assert pickle.load(f) == {'dog': 1}
@@ -0,0 +1,19 @@
+from guessing.sample import blocks, write_sample
+from test_model import toy_grammar
+
+
+def test_write_sample(tmp_path):
+    grammar = toy_grammar()
+
+    assert [size for _, size in blocks(50, seed=1, block_size=7)] == [7] * 7 + [1]
+    assert blocks(0, seed=1) == []
+
+    samples = []
+    for num_workers in (1, 3):
+        output = str(tmp_path / 'sample{}.txt'.format(num_workers))
+        write_sample(grammar, 50, output, seed=1, num_workers=num_workers, block_size=7)
+        with open(output) as f:
+            samples.append(sorted(f))
+
+    assert len(samples[0]) == 50
+    assert samples[0] == samples[1]
@@ -0,0 +1,112 @@
+import io
+import os
+import random
+from collections import Counter
+
+from guessing.score import (Scorer, format_parses, format_result, read_chunks, score_aggregate,
+                            score_chunks, score_deduplicated, tally)
+from helpers import toy_scorer
+from learning import storage
+from learning.model import Grammar, VocabularyTrie
+
+
+def ambiguous_scorer(tmp_path):
+    passwords = [
+        ([('love', 'vv0', None), ('123', None, None)], 6),
+        ([('love', 'nn1', None), ('123', None, None)], 2),
+        ([('lo', 'nn1', None), ('ve', 'nn1', None), ('123', None, None)], 2),
+    ]
+    return toy_scorer(tmp_path, passwords, {'love': [('vv0', 1.0), ('nn1', 1 / 3)],
+                                            'lo': [('nn1', 1 / 3)],
+                                            've': [('nn1', 1 / 3)],
+                                            '123': [('number3', 1.0)]})
+
+
+def test_parses(tmp_path):
+    scorer = ambiguous_scorer(tmp_path)
+
+    expected = [('(vv0)(number3)', ['', 'love', '123'], 0.6),
+                ('(nn1)(number3)', ['', 'love', '123'], 0.2 / 3),
+                ('(nn1)(nn1)(number3)', ['', 'lo', 've', '123'], 0.2 / 9)]
+
+    for k in (1, 2, 3, 10):
+        parses = scorer.parses('love123', k)
+        assert len(parses) == min(k, 3)
+        for (password, base_struct, segmentation, p), parse in zip(parses, expected):
+            assert (password, base_struct, segmentation) == ('love123',) + parse[:2]
+            assert abs(p - parse[2]) < 1e-12
+
+    assert scorer.score('love123') == scorer.parses('love123', 3)[0]
+    assert scorer.parses('lovelove', 3) == []
+    assert scorer.score('lovelove') == ('lovelove', None, None, 0)
+
+    # digits only are parsed by the lattice too; the base structures have no (number3) alone
+    assert scorer.parses('123', 3) == []
+
+    # only one of them has the split of the camel case
+    parses = scorer.parses('LoVe123', 3)
+    assert format_parses('LoVe123', parses, camelcase=True) == \
+        'LoVe123 (nn1)(nn1)(number3) {}\n'.format(parses[2][3])
+    assert format_parses('LoVe123', parses[:2], camelcase=True) == 'LoVe123 None 0\n'
+    assert format_parses('love123', scorer.parses('love123', 2)).count('\n') == 2
+
+
+def test_lazy_grammar(tmp_path):
+    scorer = ambiguous_scorer(tmp_path)
+    scorer.grammar.write_to_disk(str(tmp_path / 'grammar'), text=False)
+
+    grammar = Grammar.from_files(str(tmp_path / 'grammar'), lazy=True)
+    lazy = Scorer(grammar, None, None,
+                  word_tags=storage.WordTags(str(tmp_path / 'word_tags.bin'), grammar))
+
+    # the vocabulary and its trie are read from grammar.bin, not rebuilt
+    assert isinstance(lazy.vocab, storage.Vocabulary)
+    assert isinstance(lazy.trie, VocabularyTrie) and isinstance(lazy.trie.first, memoryview)
+
+    for password in ('love123', 'LoVe123', 'lovelove', '123'):
+        assert lazy.parses(password, 3) == scorer.parses(password, 3)
+
+
+def test_score_chunks(tmp_path):
+    scorer = ambiguous_scorer(tmp_path)
+    lines = ['{}\n'.format(p) for p in ['love123', 'LoVe123', 'lovelove', 'lo', 've123'] * 3]
+
+    for skip in (0, 4):
+        expected = ''.join(format_result(scorer.score(line.rstrip())) for line in lines[skip:])
+        for num_workers in (1, 3):
+            scored = list(score_chunks(read_chunks(iter(lines), skip, chunk_size=2), scorer, {},
+                                       num_workers=num_workers))
+            assert sum(n for n, _ in scored) == len(lines) - skip
+            assert ''.join(output for _, output in scored) == expected
+
+
+def test_duplicates(tmp_path):
+    scorer = ambiguous_scorer(tmp_path)
+    passwords = ['love123'] * 5 + ['LoVe123'] * 3 + ['lovelove'] * 2 + ['lo', 've123', '123']
+    random.Random(1).shuffle(passwords)
+    lines = ['{}\n'.format(p) for p in passwords]
+
+    partitions = list(tally(iter(lines), partitions=4))
+    assert len(partitions) == 4
+    assert sum(partitions, Counter()) == Counter(passwords)
+    assert sum(len(counts) for counts in partitions) == len(set(passwords))
+    assert list(tally(iter(lines))) == [Counter(passwords)]
+
+    expected = {p: format_result(scorer.score(p)) for p in passwords}
+
+    for partitions in (1, 4):
+        out = io.StringIO()
+        score_aggregate(iter(lines), out, scorer, {}, num_workers=3, chunk_size=2,
+                        partitions=partitions)
+        assert sorted(out.getvalue().splitlines(True)) == \
+            sorted('{}\t{}'.format(n, expected[p]) for p, n in Counter(passwords).items())
+
+    # a pipe can't seek, so it is spooled to a temporary file
+    read, write = os.pipe()
+    with open(write, 'w') as f:
+        f.writelines(lines)
+    with open(read) as f:
+        assert not f.seekable()
+        out = io.StringIO()
+        score_deduplicated(f, out, scorer, {}, num_workers=3, chunk_size=2)
+    assert out.getvalue() == ''.join(expected[p] for p in passwords)
@@ -22,7 +22,7 @@ for k in range(10):
 
     matches = list(score.score((pwd[0] for pwd in sample),
                                grammar, tc_nouns, tc_verbs, postagger,
-                               grammar.get_vocab()))
+                               grammar.vocabulary()))
 
     num_wrong = 0
     for i, (pwd, base_struct, p) in enumerate(sample):
@@ -0,0 +1,126 @@
+import asyncio
+
+import pandas as pd
+
+from guessing.service import LatencyHistogram, ScoringClient, ScoringService
+from guessing.strength import StrengthEstimator
+from helpers import toy_scorer
+
+
+def service_scorer(tmp_path):
+    passwords = [
+        ([('love', 'vv0', None), ('123', None, None)], 10),
+        ([('hate', 'vv0', None), ('123', None, None)], 2),
+        ([('dogs', 'nn2', 'dog.n.01')], 5),
+    ]
+    return toy_scorer(tmp_path, passwords, {'love': [('vv0', 10 / 12)],
+                                            'hate': [('vv0', 2 / 12)],
+                                            'dogs': [('dog.n.01', 1.0)],
+                                            '123': [('number3', 1.0)]})
+
+
+def test_latency_histogram():
+    h = LatencyHistogram()
+    assert h.quantile(0.5) is None
+    for seconds in (0.0003, 0.0004, 0.002, 0.2):
+        h.add(seconds)
+    assert h.count == 4
+    assert h.quantile(0.5) == 0.5 and h.quantile(0.75) == 2.5 and h.quantile(1) == 250
+    assert h.to_dict()['buckets'][-1] == ['+Inf', 0]
+
+
+def test_service(tmp_path):
+    scorer = service_scorer(tmp_path)
+    sample = pd.DataFrame({'p': [0.5, 0.25, 0.125, 0.125]})
+    estimator = StrengthEstimator(sample['p'])
+
+    async def run():
+        service = ScoringService(scorer, estimator, max_batch=3)
+        server = await service.start(path=str(tmp_path / 'scorer.sock'))
+        client = ScoringClient(path=str(tmp_path / 'scorer.sock'))
+        try:
+            results = await client.score(['love123', 'dogs', 'xyz'])
+
+            status, single = await client.request('POST', '/score', {'password': 'hate123'})
+            assert status == 200 and len(single['results']) == 1
+
+            errors = [(await client.request('POST', '/score', {'passwords': ['a'] * 4}))[0],
+                      (await client.request('GET', '/score'))[0],
+                      (await client.request('POST', '/score', {'passwords': 'love'}))[0],
+                      (await client.request('GET', '/nothing'))[0]]
+            stats = await client.stats()
+        finally:
+            server.close()
+            await server.wait_closed()
+            service.close()
+        return results, single['results'][0], errors, stats
+
+    results, single, errors, stats = asyncio.run(run())
+
+    for result, password in zip(results, ['love123', 'dogs', 'xyz']):
+        expected = scorer.score(password)
+        assert (result['password'], result['base_struct'], result['segmentation'], result['p']) \
+            == (expected[0], expected[1], expected[2], expected[3])
+
+    assert abs(results[0]['p'] - 10 / 17) < 1e-12
+    assert results[0]['guess_number'] == estimator.guess_number(10 / 17)
+    assert results[2]['p'] == 0 and results[2]['guess_number'] is None
+    assert single['password'] == 'hate123' and abs(single['p'] - 2 / 17) < 1e-12
+
+    assert errors == [413, 405, 400, 404]
+    assert stats['requests'] == 2 and stats['passwords'] == 4 and stats['errors'] == 4
+    assert stats['latency']['password']['count'] == 4
+
+
+def test_service_errors(tmp_path):
+    scorer = service_scorer(tmp_path)
+
+    class FailingScorer(object):
+        def score(self, password):
+            raise RuntimeError(password)
+
+    async def raw(path, request):
+        """ Returns the status line of the response to a raw request, or
+        b'' if the connection was closed without one.
+        """
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(request)
+        await writer.drain()
+        status = await reader.readline()
+        writer.close()
+        return status.split()[1] if status else b''
+
+    async def run(scorer, requests):
+        path = str(tmp_path / 'scorer.sock')
+        service = ScoringService(scorer, max_body=1000)
+        server = await service.start(path=path)
+        client = ScoringClient(path=path)
+        try:
+            statuses = []
+            for request in requests:
+                if isinstance(request, bytes):
+                    statuses.append(int(await raw(path, request)))
+                else:
+                    statuses.append((await client.request('POST', '/score', request))[0])
+            statuses.append((await client.request('POST', '/score', {'password': 'love123'}))[0])
+            return statuses, (await client.stats())['errors']
+        finally:
+            server.close()
+            await server.wait_closed()
+            service.close()
+
+    # bodies that are JSON but not objects, requests that can't be framed
+    # (a header line past the limit of the reader) and bodies that are too long
+    requests = [['love'], 'love', 5,
+                b'POST /score HTTP/1.1\r\nContent-Length: five\r\n\r\n',
+                b'POST /score HTTP/1.1\r\nContent-Length: -1\r\n\r\n',
+                b'POST\r\n\r\n',
+                b'POST /score HTTP/1.1\r\nX-Padding: ' + b'a' * 100000 + b'\r\n\r\n',
+                b'POST /score HTTP/1.1\r\nContent-Length: 1001\r\n\r\n',
+                {'passwords': ['love123'] * 1000}]
+    statuses, errors = asyncio.run(run(scorer, requests))
+    assert statuses == [400] * 7 + [413, 413, 200] and errors == 9
+
+    # errors while scoring
+    statuses, errors = asyncio.run(run(FailingScorer(), []))
+    assert statuses == [500] and errors == 1
@@ -1,7 +1,7 @@
 # %cd test
 from context import _li_abe, \
-    li_abe, WordNetTreeNode, WordNetTree, DefaultTree, \
-    MleEstimator, LaplaceEstimator, DepthFirstIterator
+    li_abe, wagner, bootstrap, ArrayTree, WordNetTreeNode, WordNetTree, \
+    DefaultTree, MleEstimator, LaplaceEstimator, DepthFirstIterator, model
 
 import pickle
 
@@ -90,6 +90,144 @@ def test_dl_with_nodes():
     assert cut_mle[1].key == 'INSECT'
 
 
+def test_collapsed_tree_cut():
+    ENTITY = WordNetTreeNode('ENTITY')
+    ANIMAL = WordNetTreeNode('ANIMAL')
+    ARTIFACT = WordNetTreeNode('ARTIFACT')
+    BIRD = WordNetTreeNode('BIRD')
+    INSECT = WordNetTreeNode('INSECT')
+    VEHICLE = WordNetTreeNode('VEHICLE')
+
+    ENTITY.add_child(ANIMAL)
+    ENTITY.add_child(ARTIFACT)
+    ANIMAL.add_child(BIRD)
+    ANIMAL.add_child(INSECT)
+    ARTIFACT.add_child(VEHICLE)
+    for key, value in [('swallow', 4), ('crow', 4), ('eagle', 4), ('bird', 6)]:
+        BIRD.add_child(WordNetTreeNode(key, value=value))
+    for key, value in [('bug', 0), ('bee', 0), ('insect', 0)]:
+        INSECT.add_child(WordNetTreeNode(key, value=value))
+    for key, value in [('car', 0), ('bike', 0)]:
+        VEHICLE.add_child(WordNetTreeNode(key, value=value))
+
+    ENTITY.updateCounts()
+
+    tree = WordNetTree('n', init=False)
+    tree.root = ENTITY
+    collapsed = tree.collapsed()
+
+    # zero-count subtrees become leaves that keep their leaf count
+    assert len(collapsed.leaves()) == 6
+    assert collapsed.root.leaf_count == ENTITY.leaf_count == 9
+    insect = collapsed.root.leftchild.leftchild.rightsibling
+    assert insect.key == 'INSECT' and insect.is_leaf()
+    assert insect.leaf_count == 3 and insect.origin is INSECT
+
+    N = ENTITY.value
+    for estimator in [None, MleEstimator(N), LaplaceEstimator(N, 9, 1)]:
+        cut = li_abe.findcut(tree, estimator)
+        cut_collapsed = li_abe.findcut(collapsed, estimator)
+        assert [node.origin for node in cut_collapsed] == cut
+
+        cut = wagner.findcut(tree, 10, estimator)
+        cut_collapsed = wagner.findcut(collapsed, 10, estimator)
+        assert [node.origin for node in cut_collapsed] == cut
+
+
+def test_vectorized_cut():
+    t = DefaultTree()
+    t.root = WordNetTreeNode('ENTITY')
+    t.insert(['ANIMAL', 'BIRD', 'swallow'], 4, cumulative=False)
+    t.insert(['ANIMAL', 'BIRD', 'crow'], 4, cumulative=False)
+    t.insert(['ANIMAL', 'BIRD', 'eagle'], 4, cumulative=False)
+    t.insert(['ANIMAL', 'BIRD', 'bird'], 6, cumulative=False)
+    t.insert(['ANIMAL', 'INSECT', 'bug'], 0, cumulative=False)
+    t.insert(['ANIMAL', 'INSECT', 'bee'], 8, cumulative=False)
+    t.insert(['ANIMAL', 'INSECT', 'insect'], 0, cumulative=False)
+    t.insert(['ARTIFACT', 'VEHICLE', 'car'], 1, cumulative=False)
+    t.insert(['ARTIFACT', 'VEHICLE', 'bike'], 0, cumulative=False)
+    t.insert(['ARTIFACT', 'AIRPLANE', 'jet'], 4, cumulative=False)
+    t.insert(['ARTIFACT', 'AIRPLANE', 'helicopter'], 0, cumulative=False)
+    t.insert(['ARTIFACT', 'AIRPLANE', 'airplane'], 4, cumulative=False)
+    t.root.updateCounts()
+
+    tree = ArrayTree(t)
+    values = tree.accumulate(tree.value[tree.leaves][:, None])
+    assert (values[:, 0] == tree.value).all()
+
+    N = t.root.value
+    for name, estimator in [('mle', MleEstimator(N)),
+                            ('laplace', LaplaceEstimator(N, t.root.leaf_count, 1))]:
+        for weight in [None, 5, 50]:
+            if weight is None:
+                cut = li_abe.findcut(t, estimator)
+            else:
+                cut = wagner.findcut(t, weight, estimator)
+            found = bootstrap.findcuts(tree, values, name, weight)[:, 0]
+            assert [node.id for node in cut] == list(tree.ids[found])
+
+
+def test_bootstrap():
+    tree = WordNetTree('n', init=False)
+    tree.root = WordNetTreeNode('root')
+    for path, count in [(['animal', 'bird', 'crow'], 40),
+                        (['animal', 'bird', 'eagle'], 35),
+                        (['animal', 'insect', 'bee'], 3),
+                        (['animal', 'insect', 'bug'], 0),
+                        (['artifact', 'car'], 10),
+                        (['artifact', 'bike'], 0)]:
+        tree.insert(path, count, cumulative=False)
+    tree.updateCounts()
+
+    tcm = model.TreeCutModel('n', estimator='laplace')
+    tcm.fit_tree(tree)
+
+    results = bootstrap.bootstrap(tcm, 60, num_workers=1, seed=1, block_size=25)
+    assert results == bootstrap.bootstrap(tcm, 60, num_workers=2, seed=1, block_size=25)
+
+    cut = set(node.key for node in tcm.treecut)
+    assert set(key for key, f, in_cut in results if in_cut) == cut
+    assert all(0 < f <= 1 for key, f, in_cut in results if not in_cut)
+
+
+def test_synset_index():
+    # dog.n.01 has two hypernym paths, so it is duplicated in the tree
+    tree = WordNetTree('n', init=False)
+    tree.root = WordNetTreeNode('root')
+    for path in [['animal.n.01', 'dog.n.01', 's.dog.n.01'],
+                 ['animal.n.01', 'dog.n.01', 'puppy.n.01'],
+                 ['pet.n.01', 's.pet.n.01'],
+                 ['pet.n.01', 'dog.n.01', 's.dog.n.01'],
+                 ['pet.n.01', 'dog.n.01', 'puppy.n.01']]:
+        tree.insert(path, 0)
+    tree.index_synsets()
+
+    leaves = [leaf.key for leaf in tree.leaf_nodes]
+    assert leaves == ['s.dog.n.01', 'puppy.n.01', 's.pet.n.01',
+                      's.dog.n.01', 'puppy.n.01']
+    assert list(tree.synset_leaves('dog.n.01')) == [0, 3]
+    assert list(tree.synset_leaves('pet.n.01')) == [2]
+    assert tree.synset_leaves('cat.n.01') is None
+
+    tree.increment_synset(Synset('dog.n.01'), 4)
+    assert tree.leaf_nodes[3].value == 2
+    assert tree.root.value == 4
+
+    # the index is part of the snapshot
+    tree2 = pickle.loads(pickle.dumps(tree))
+    assert list(tree2.synset_leaves('puppy.n.01')) == [1, 4]
+    assert [leaf.key for leaf in tree2.leaf_nodes] == leaves
+
+
+class Synset(object):
+    """ Stand-in for nltk's Synset """
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+
 def test_laplace_estimator():
     cut1 = [('ANIMAL', 10, 7)]
     cut2 = [('BIRD', 8, 4), ('INSECT', 2, 3)]
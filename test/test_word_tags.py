@@ -0,0 +1,36 @@
+from guessing.score import Scorer
+from guessing.word_tags import word_tags
+from learning import storage
+from test_score import ambiguous_scorer
+
+
+class StubTagger(object):
+    """ Tags words like MemoTagger.get_tags(), from a dict. """
+
+    TAGS = {'love': {('vv0', 1.0), ('nn1', 1 / 3), ('jj', 0.5)},  # jj isn't in the grammar
+            'lo': {('nn1', 1 / 3)},
+            've': {('nn1', 1 / 3), ('vv0', 0.0)},
+            '123': {('number3', 1.0)}}
+
+    def get_tags(self, word):
+        return set(self.TAGS.get(word, ()))
+
+
+def test_word_tags(tmp_path):
+    grammar = ambiguous_scorer(tmp_path).grammar
+    stub = StubTagger()
+
+    table = word_tags(grammar, stub, num_workers=2, chunk_size=1)
+    assert table == {word: sorted(tags) for word, tags in StubTagger.TAGS.items()}
+
+    path = str(tmp_path / 'stub_word_tags.bin')
+    storage.write_word_tags(path, table)
+    scorer = Scorer(grammar, None, None, word_tags=storage.WordTags(path, grammar))
+
+    tagged = Scorer(grammar, None, None, postagger=stub)
+    tagged.memotagger = stub
+
+    for word in StubTagger.TAGS:
+        assert sorted(scorer.tags(word)) == sorted(tagged.tags(word))
+    for password in ('love123', 'LoVe123', 'lovelove', 've123', '123'):
+        assert scorer.parses(password, 3) == tagged.parses(password, 3)